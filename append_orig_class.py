@@ -2,31 +2,155 @@
 
 __author__ = 'Xiaoguang Zhu'
 
-''''''
+'''
+Backfill columns `orig_class` and `count` of `encodings.db` in bulk.
 
-import pandas as pd
+`orig_class` is column 0 of the original `.tsv` (served from the index when
+one exists, see `tsv_index.py`), `count` is the number of faces in the
+`encoding` blob. Each chunk is written with `executemany()` into a temporary
+table, then merged with a single `UPDATE ... FROM` join, instead of one
+`UPDATE` per record.
+
+Usage::
+
+    python append_orig_class.py [--no-count] [--build-indexes]
+'''
 
 import sqlite3
 
-orig_reader = pd.read_csv('../FaceImageCroppedWithoutAlignment.tsv',
-                          sep='\t', header=None, chunksize=1000)
-
-with sqlite3.connect('./encodings.db') as conn:
-    c = conn.cursor()
-    for chunk in orig_reader:
-        for idx, rec in chunk.iterrows():
-            orig_class = rec[0]
-            print('ID {} : {}'.format(rec.name, orig_class))
-            c.execute(
-                '''
-                UPDATE encodings
-                SET
-                    orig_class = ?
-                WHERE
-                    id = ?
-                ''',
-                (orig_class, rec.name)
-            )
-        conn.commit()
+import argparse
+
+from tsv_reader import iter_chunks
+from encoding_store import ensure_schema, count_encodings, fetch_range
+from storage import connect
+
+
+''' Configurations '''
+
+ORIG_DATA_PATH  = '../FaceImageCroppedWithoutAlignment.tsv'
+DATABASE_PATH   = './encodings.db'
+
+CHUNK_SIZE      = int(1e5)
+
+# indexes on `encodings` used by later stages
+INDEXES = {
+    'encodings_orig_class': 'orig_class',   # per-segment lookups
+    'encodings_belong':     'belong',       # joins in `dump_folders.py`
+    'encodings_count':      'count',        # single-face filtering
+}
+
+# `UPDATE ... FROM` is only supported since SQLite 3.33.0
+UPDATE_FROM_SUPPORTED = sqlite3.sqlite_version_info >= (3, 33, 0)
+
+
+''' Helper Functions '''
+
+def create_backfill_table(db_cursor):
+    db_cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS backfill (
+            id          integer     primary key     ,
+            orig_class  text                        ,
+            count       integer
+        )'''
+    )
+
+
+def merge_backfill(db_cursor):
+    '''
+    merge temp table `backfill` into `encodings`, `NULL`s in `backfill` keep
+    the old values, and so does `count` already written by `extract_to_db.py`
+    '''
+    if UPDATE_FROM_SUPPORTED:
+        db_cursor.execute('''
+            UPDATE encodings
+            SET
+                orig_class = coalesce(b.orig_class, encodings.orig_class),
+                count = coalesce(encodings.count, b.count)
+            FROM backfill AS b
+            WHERE
+                encodings.id = b.id
+        ''')
+    else:
+        db_cursor.execute('''
+            UPDATE encodings
+            SET
+                orig_class = coalesce(
+                    (SELECT orig_class FROM backfill WHERE id = encodings.id),
+                    orig_class),
+                count = coalesce(
+                    count,
+                    (SELECT count FROM backfill WHERE id = encodings.id))
+            WHERE
+                id IN (SELECT id FROM backfill)
+        ''')
+    db_cursor.execute('DELETE FROM backfill')
+
+
+def build_indexes(db_connection):
+    for name, column in INDEXES.items():
+        print('Building index {}...'.format(name))
+        db_connection.execute(
+            'CREATE INDEX IF NOT EXISTS {} ON encodings ({})'
+            .format(name, column)
+        )
+    db_connection.commit()
+
+
+''' Processes '''
+
+def process_chunk(db_connection, encoding_format, chunk, with_count=True):
+    '''
+    backfill one chunk of records
+
+    Args:
+        `db_connection`: database connection
+        `encoding_format`: blob format of the database
+        `chunk`: chunk of records with column `segment`, see `tsv_reader.py`
+        `with_count`: also backfill `count` from the encoding blobs
+    '''
+    c = db_connection.cursor()
+    counts = {}
+    if with_count:
+        blobs = fetch_range(c, chunk[0].idx, chunk[-1].idx)
+        counts = {idx: count_encodings(blob, encoding_format)
+                  for idx, blob in blobs.items()}
+    c.executemany(
+        'INSERT INTO backfill (id, orig_class, count) VALUES (?, ?, ?)',
+        [(rec.idx, rec.segment, counts.get(rec.idx)) for rec in chunk]
+    )
+    merge_backfill(c)
+    db_connection.commit()
+
+
+def main(with_count=True, with_indexes=False, chunksize=CHUNK_SIZE):
+    orig_reader = iter_chunks(ORIG_DATA_PATH, columns=('segment',),
+                              chunksize=chunksize)
+    with connect(DATABASE_PATH) as conn:
+        encoding_format = ensure_schema(conn)
+        create_backfill_table(conn.cursor())
+        for chunk in orig_reader:
+            print('Backfilling {} - {}...'
+                  .format(chunk[0].idx, chunk[-1].idx))
+            process_chunk(conn, encoding_format, chunk, with_count)
+        if with_indexes:
+            build_indexes(conn)
     print('All done!')
 
+
+''' Main '''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='''Backfill columns `orig_class` and `count` of
+`encodings.db`.''')
+    parser.add_argument('--no-count', action='store_true',
+                        help='''Only backfill `orig_class`, skip reading
+encoding blobs.''')
+    parser.add_argument('--build-indexes', action='store_true',
+                        help='''Create indexes on `orig_class`, `belong` and
+`count` afterwards.''')
+    parser.add_argument('-cs', '--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='''Records per batch.''')
+    args = parser.parse_args()
+    main(with_count=not args.no_count, with_indexes=args.build_indexes,
+         chunksize=args.chunk_size)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Decode throughput of `image_decode.py` against the old `matplotlib` path,
+and agreement of the resulting face encodings.
+
+Payloads are the first records of the original `.tsv` if given, otherwise
+synthetic JPEGs. Encoding agreement needs `face_recognition`, and is reported
+as how often the number of faces found matches, and the mean distance of the
+first encoding, against the first decoder (the old path if available).
+
+Usage::
+
+    python benchmarks/bench_decode.py [data.tsv [records]] [--sizes 160 80]
+'''
+
+import io
+import os
+import sys
+import time
+import base64
+import argparse
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from image_decode import decode_image
+from tsv_reader import COLUMNS
+
+
+''' Configurations '''
+
+RECORDS = 500
+MAX_SIZES = (None, 160, 80)
+# side of synthetic images
+SYNTHETIC_SIZE = 250
+
+
+''' Payloads '''
+
+def read_payloads(tsv_path, records):
+    payloads = []
+    with open(tsv_path, 'r') as f:
+        for line in f:
+            payloads.append(line.rstrip('\r\n').split('\t')[COLUMNS['image']])
+            if len(payloads) >= records:
+                break
+    return payloads
+
+
+def synthetic_payloads(records, size=SYNTHETIC_SIZE, seed=0):
+    rng = np.random.RandomState(seed)
+    payloads = []
+    for _ in range(records):
+        # smooth noise compresses like a photo, unlike white noise
+        small = rng.randint(0, 255, (size // 16, size // 16, 3)) \
+                   .astype(np.uint8)
+        img = Image.fromarray(small).resize((size, size), Image.BILINEAR)
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=90)
+        payloads.append(base64.b64encode(buf.getvalue()).decode('ascii'))
+    return payloads
+
+
+''' Decoders '''
+
+def get_matplotlib_decoder():
+    '''
+    the decode path used before `image_decode.py`, `None` if `matplotlib` is
+    not installed
+    '''
+    try:
+        import matplotlib.image as mpimage
+    except ImportError:
+        return None
+
+    def decode(payload):
+        img = mpimage.imread(io.BytesIO(base64.b64decode(payload)),
+                             format='jpg')
+        img.setflags(write=True)
+        return img
+    return decode
+
+
+def bench(decode, payloads):
+    start = time.perf_counter()
+    images = [decode(payload) for payload in payloads]
+    return len(payloads) / (time.perf_counter() - start), images
+
+
+''' Main '''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Decode throughput and encoding agreement.')
+    parser.add_argument('tsv', nargs='?', help='Original data.')
+    parser.add_argument('records', nargs='?', type=int, default=RECORDS)
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        help='Max sizes to decode at, besides full size.')
+    args = parser.parse_args()
+    sizes = MAX_SIZES if args.sizes is None else [None] + args.sizes
+
+    payloads = read_payloads(args.tsv, args.records) if args.tsv \
+        else synthetic_payloads(args.records)
+    print('{} payloads.'.format(len(payloads)))
+
+    try:
+        import face_recognition as fr
+    except ImportError:
+        fr = None
+        print('`face_recognition` not installed, skipping agreement.')
+
+    decoders = []
+    decode_mpl = get_matplotlib_decoder()
+    if decode_mpl is None:
+        print('`matplotlib` not installed, skipping old path.')
+    else:
+        decoders.append(('matplotlib', decode_mpl))
+    for max_size in sizes:
+        decoders.append(('PIL max_size={}'.format(max_size),
+                         lambda p, m=max_size: decode_image(p, m)))
+
+    reference = None
+    print('{:<22}{:>12}{:>10}{:>12}{:>12}'.format(
+        'decoder', 'images/s', 'shape', 'same count', 'mean dist'))
+    for name, decode in decoders:
+        rate, images = bench(decode, payloads)
+        agreement = ('', '')
+        if fr is not None:
+            encodings = [fr.face_encodings(img) for img in images]
+            if reference is None:
+                reference = encodings
+            same = [len(a) == len(b) for a, b in zip(encodings, reference)]
+            dists = [np.linalg.norm(a[0] - b[0])
+                     for a, b in zip(encodings, reference) if a and b]
+            agreement = ('{:.1%}'.format(np.mean(same)),
+                         '{:.4f}'.format(np.mean(dists)) if dists else '-')
+        print('{:<22}{:>12.1f}{:>10}{:>12}{:>12}'.format(
+            name, rate, 'x'.join(map(str, images[0].shape[:2])),
+            *agreement))
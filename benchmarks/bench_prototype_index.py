@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Recall / speed of `IVFIndex` against exhaustive prototype matching, on
+synthetic encodings shaped like `face_recognition` ones: different people are
+~0.9 apart, faces of the same person ~0.35 from their prototype.
+
+Usage::
+
+    python benchmarks/bench_prototype_index.py [prototypes ...]
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from encoding_store import ENCODING_DIM
+from prototypes import PrototypeMatrix
+from prototype_index import IVFIndex
+
+
+''' Configurations '''
+
+TOLERANCE = 0.55
+QUERIES = 2000
+# fraction of queries of people never seen before
+NEW_PEOPLE_RATIO = 0.2
+PERSON_SPREAD = 0.9
+FACE_SPREAD = 0.35
+NPROBES = (1, 4, 8, 16)
+
+
+''' Benchmark '''
+
+def make_data(prototypes_count, queries_count=QUERIES, seed=0):
+    rng = np.random.RandomState(seed)
+    sigma = PERSON_SPREAD / np.sqrt(2 * ENCODING_DIM)
+    people = rng.normal(0, sigma, (prototypes_count, ENCODING_DIM))
+    noise = rng.normal(0, FACE_SPREAD / np.sqrt(ENCODING_DIM),
+                       (queries_count, ENCODING_DIM))
+    known = rng.rand(queries_count) >= NEW_PEOPLE_RATIO
+    queries = np.where(
+        known[:, None],
+        people[rng.randint(prototypes_count, size=queries_count)],
+        rng.normal(0, sigma, (queries_count, ENCODING_DIM))) + noise
+    counts = rng.zipf(2., prototypes_count)
+    return people.astype(np.float32), counts, queries.astype(np.float32)
+
+
+def build(people, counts, index=None):
+    prototypes = PrototypeMatrix(capacity=len(people), index=index)
+    for klass, (encoding, count) in enumerate(zip(people, counts)):
+        prototypes.add(klass, encoding, klass, count)
+    return prototypes
+
+
+def run(prototypes, queries):
+    start = time.perf_counter()
+    results = [prototypes.match(query, TOLERANCE) for query in queries]
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+def bench(prototypes_count):
+    people, counts, queries = make_data(prototypes_count)
+    exact, exact_time = run(build(people, counts), queries)
+    matched = sum(r is not None for r in exact)
+    print('{} prototypes, {} queries ({} matched)'
+          .format(prototypes_count, len(queries), matched))
+    print('    {:<16}{:>12}{:>10}{:>10}'
+          .format('method', 'us/query', 'speedup', 'recall'))
+    print('    {:<16}{:>12.1f}{:>10}{:>10}'
+          .format('exhaustive', exact_time * 1e6, '1.0x', '1.000'))
+    for nprobe in NPROBES:
+        start = time.perf_counter()
+        prototypes = build(people, counts, IVFIndex(nprobe=nprobe))
+        build_time = time.perf_counter() - start
+        approx, approx_time = run(prototypes, queries)
+        # recall: queries whose exhaustive answer is found
+        recall = (sum(a == e for a, e in zip(approx, exact)
+                      if e is not None) / max(matched, 1))
+        print('    {:<16}{:>12.1f}{:>9.1f}x{:>10.3f}   (build {:.2f}s)'
+              .format('ivf nprobe={}'.format(nprobe), approx_time * 1e6,
+                      exact_time / approx_time, recall, build_time))
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [2000, 5000, 10000, 20000, 50000]
+    for size in sizes:
+        bench(size)
@@ -5,16 +5,26 @@ __author__ = 'Xiaoguang Zhu'
 ''''''
 
 # import numpy as np
-import pandas as pd
 
 import os
+import multiprocessing as mp
 
-import base64
-import pickle
+from collections import OrderedDict
 
-import sqlite3
+import argparse
 
-import face_recognition as fr
+from tsv_reader import COLUMNS, iter_chunks, get_record_type
+from tsv_index import TsvIndex
+from encoding_store import (FORMAT_PACKED, get_encoding_format,
+                            pack_encodings, unpack_encodings, fetch_range,
+                            fetch_ids)
+from prototypes import PrototypeMatrix
+from prototype_index import IVFIndex
+from image_writer import open_image_writer
+from storage import (SQL_VARIABLES_LIMIT, SHARED_PRAGMAS, UPDATE_COUNT,
+                     UPDATE_BELONG, GroupCommit, connect)
+from stages import QUEUE_BYTES, prefetch
+from coordinator import COORDINATOR_PATH, Coordinator, LeaseLost
 
 
 ''' Configurations '''
@@ -27,20 +37,71 @@ TOP_DB_PATH = './encodings.db'
 SEGMENT_DB_DIR = './segment_db'
 
 OUTPUT_ROOT_PATH = './output'
+# `'folders'` or `'packed'`, see `image_writer.py`
+OUTPUT_MODE = 'folders'
+
+# maximum distance for two encodings to be considered the same person
+TOLERANCE = 0.55        # TODO: TUNE THIS!!!
+
+# weight of a new member when updating class prototype as running average
+# `(1 - tau) * old + tau * new`, `0` to keep the first member as prototype
+EMA_TAU = 0.
+
+# match against an approximate nearest-neighbour index of prototypes instead
+# of all of them, see `prototype_index.py`
+USE_ANN_INDEX = False
+
+# global (non-segment) mode, see `global_chunk_process()`
+# records processed between two prunings of `seen_classes`
+PRUNE_INTERVAL = int(1e5)
+# minimum members per record processed since a class is created
+PRUNE_MIN_RATE = 1e-5
+
+# read chunks and their encodings ahead in a background thread, see
+# `stages.py`
+STAGED = False
+
+# segment databases kept open across records and chunks, see `SegmentPool`
+SEGMENT_POOL_SIZE = 64
+
+# classify whole segments on a pool of this many processes, see
+# `parallel_main()`
+PROCESSES_COUNT = 1
+# segments handed to a worker at a time
+SEGMENTS_PER_TASK = 8
+
+# classify segments leased from the coordinator, see `coordinator.py`
+COORDINATE = False
+WORKER_ID = None
+
+# blob format of top-level database, see `encoding_store.py`
+encoding_format = FORMAT_PACKED
+# background image writer, created in `main()`
+image_writer = None
+# open segment databases, created in `main()`
+segment_pool = None
 
 
 ''' Helper Functions - Session Controll '''
 
 
-def load_breakpoint():
-    with sqlite3.connect(TOP_DB_PATH) as conn:
+def create_breakpoints(conn, table='breakpoints'):
+    conn.execute('CREATE TABLE IF NOT EXISTS {} (idx integer)'.format(table))
+    if conn.execute('SELECT * FROM {}'.format(table)).fetchone() is None:
+        conn.execute('INSERT INTO {} (idx) VALUES (0)'.format(table))
+    conn.commit()
+
+
+def load_breakpoint(table='breakpoints'):
+    with connect(TOP_DB_PATH) as conn:
+        create_breakpoints(conn, table)
         c = conn.cursor()
         c.execute(
             '''
-            SELECT * from breakpoints
+            SELECT * from {}
             ORDER BY idx DESC
             LIMIT 1
-            '''
+            '''.format(table)
         )
         bkpt = c.fetchone()
     if bkpt is None:
@@ -52,17 +113,20 @@ def load_breakpoint():
     return bkpt
 
 
-def save_breakpoint(conn, idx):
+def save_breakpoint(conn, idx, table='breakpoints'):
+    '''
+    update breakpoint, not committed, so that it lands in the same commit as
+    the results of its chunk
+    '''
     c = conn.cursor()
     c.execute(
         '''
-        UPDATE breakpoints
+        UPDATE {}
         SET
             idx = ?
-        ''',
+        '''.format(table),
         (idx,)
     )
-    conn.commit()
     print('Breakpoint @ {} saved!'.format(idx))
 
 
@@ -77,16 +141,21 @@ def get_encoding_from_record(record_tuple):
         `record_tuple`: record tuple returned from `db_cursor.fetchone()`
 
     Return:
-        `[ np.ndarray() ]`: list of encodings
+        `np.ndarray()`: encodings of shape `[count, 128]`
     '''
-    ret = record_tuple[1]
-    ret = pickle.loads(ret)
-    return ret
+    return unpack_encodings(record_tuple[1], encoding_format)
 
 
 ''' Helper Functions - Database '''
 
 
+def get_pragmas():
+    '''
+    `connect()` overrides, coordinated workers may run on several hosts
+    '''
+    return SHARED_PRAGMAS if COORDINATE else {}
+
+
 def update_count(db_cursor, record):
     '''
     updates the `count` column of record in top-level database
@@ -114,268 +183,792 @@ def update_count(db_cursor, record):
     return count
 
 
-def increase_class_count(seg_cursor, klass):
+def create_seen_classes(db_connection):
     '''
-    increase registered class member count by 1
+    create table `seen_classes` if not exists, `encoding` being the packed
+    prototype of the class, see `encoding_store.py`
+    '''
+    db_connection.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS seen_classes (
+            belong      integer     primary key     ,
+            first_id    integer     not null unique ,
+            count       integer     not null        ,
+            encoding    blob                        )
+        '''
+    )
+    columns = [row[1] for row in
+               db_connection.execute('PRAGMA table_info(seen_classes)')]
+    if 'encoding' not in columns:
+        db_connection.execute(
+            'ALTER TABLE seen_classes ADD COLUMN encoding blob')
+
 
-    NOTE: `klass` must be in segment database __ALREADY__!
+def save_prototypes(seg_connection, prototypes):
+    '''
+    write changed and pruned classes back to `seen_classes` in one
+    transaction
 
     Args:
-        `seg_cursor`: segment database cursor
-        `klass`: target class ID
+        `seg_connection`: segment (or top-level in global mode) database
+            connection
+        `prototypes`: `PrototypeMatrix` of the segment
     '''
-    seg_cursor.execute(
+    seg_connection.executemany(
         '''
-        SELECT count FROM seen_classes
+        DELETE FROM seen_classes
         WHERE
             belong = ?
         ''',
-        (klass,)
+        ((klass,) for klass in prototypes.pop_removed())
     )
-    orig_count = seg_cursor.fetchone()[0]
-    seg_cursor.execute(
-        '''
-        UPDATE seen_classes
-        SET
-            count = ?
-        WHERE
-            belong = ?
-        ''',
-        (orig_count + 1, klass)
-    )
-
-
-def new_class_stat(seg_cursor, klass, record_id):
-    seg_cursor.execute(
+    rows = prototypes.pop_dirty()
+    seg_connection.executemany(
         '''
-        INSERT INTO seen_classes
-            (belong, first_id, count)
-        VALUES (?, ?, 1)
+        INSERT OR REPLACE INTO seen_classes
+            (belong, first_id, count, encoding)
+        VALUES (?, ?, ?, ?)
         ''',
-        (klass, record_id)
+        ((int(prototypes.klasses[row]), int(prototypes.first_ids[row]),
+          int(prototypes.counts[row]),
+          pack_encodings(prototypes.matrix[row:row + 1]))
+         for row in rows)
     )
+    seg_connection.commit()
 
 
-def get_encoding_in_class(top_db_cursor, seg_cursor, klass):
+def load_prototypes(top_db_cursor, seg_cursor):
     '''
-    get typical encoding that was classifed with ID `klass` in segment
-    specified with the database cursor `seg_cursor`
-
-    Note:
-        Assuming records labeled with class id have one and **ONLY ONE**
-        face encoding in `encoding` blob
+    load all classes of a segment into an in-memory prototype matrix
 
     Args:
-        `top_db_cursor`: top-level database (containing encodings) cursor
+        `top_db_cursor`: top-level database cursor
         `seg_cursor`: segment database cursor
-        `klass`: class ID
 
     Return:
-        `[ np.ndarray() ]`: a list containing a single encoding array
+        `PrototypeMatrix`
     '''
-    # get typical record id from table `seen_classes`
     seg_cursor.execute(
         '''
-        SELECT first_id FROM seen_classes
-        WHERE
-            belong = ?
-        ''',
-        (klass,)
+        SELECT belong, first_id, count, encoding FROM seen_classes
+        ORDER BY belong
+        '''
     )
-    record_id = seg_cursor.fetchone()[0]
-    # retrieve encoding of that record
-    top_db_cursor.execute('''
-        SELECT * FROM encodings
-        WHERE
-            id = ?
-        ''', (record_id,))
-    record = top_db_cursor.fetchone()
-    ret = get_encoding_from_record(record)
-    return ret
+    klasses = seg_cursor.fetchall()
+    # prototypes saved along with classes
+    encodings = {
+        first_id: unpack_encodings(blob)[0]
+        for _, first_id, _, blob in klasses if blob is not None
+    }
+    # retrieve typical encodings of classes saved without one, in batches
+    missing = [first_id for _, first_id, _, blob in klasses if blob is None]
+    for start in range(0, len(missing), SQL_VARIABLES_LIMIT):
+        first_ids = missing[start:start + SQL_VARIABLES_LIMIT]
+        top_db_cursor.execute(
+            '''
+            SELECT id, encoding FROM encodings
+            WHERE
+                id IN ({})
+            '''.format(', '.join('?' * len(first_ids))),
+            first_ids
+        )
+        for record_id, blob in top_db_cursor.fetchall():
+            encodings[record_id] = unpack_encodings(blob, encoding_format)[0]
+    prototypes = PrototypeMatrix(capacity=max(2 * len(klasses), 64),
+                                 index=IVFIndex() if USE_ANN_INDEX else None)
+    for klass, first_id, count, _ in klasses:
+        prototypes.add(klass, encodings[first_id], first_id, count,
+                       dirty=False)
+    return prototypes
 
 
-def get_class_list_order_by_count(seg_cursor):
+def save_face_counts(top_db_cursor, face_counts):
     '''
-    get class IDs ordered by member counts
+    batch update `count` column of top-level database, not committed
 
     Args:
-        `seg_cursor`: segment database cursor
+        `top_db_cursor`: top-level database cursor
+        `face_counts`: `[ (count, id) ]`
+    '''
+    top_db_cursor.executemany(UPDATE_COUNT, face_counts)
 
-    Return:
-        `[ int ]`: list of class IDs in `int`, could be empty list `[]`
+
+def save_belongs(top_db_cursor, belongs):
     '''
-    seg_cursor.execute(
-        '''
-        SELECT belong FROM seen_classes
-        ORDER BY count DESC
-        '''
-    )
-    ret = seg_cursor.fetchall()
-    ret = list(map(lambda tup: tup[0], ret))
-    return ret
+    batch update `belong` column of top-level database, not committed
+
+    Args:
+        `top_db_cursor`: top-level database cursor
+        `belongs`: `[ (klass, id) ]`
+    '''
+    top_db_cursor.executemany(UPDATE_BELONG, belongs)
 
 
 ''' Helper Functions - File I/O '''
 
 
+def get_segment_db_path(segment):
+    return os.path.join(SEGMENT_DB_DIR, '{}.db'.format(segment))
+
+
+def remove_segment_db(segment):
+    path = get_segment_db_path(segment)
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+
 def dump_to_folder(orig_data_rec, klass, format='jpg'):
     '''
-    dump image file to corresponding folder
+    dump image file to corresponding folder (or packed shard)
 
     Args:
-        `orig_data_rec`: original data read in by `pandas`
+        `orig_data_rec`: original data record, see `tsv_reader.py`
         `klass`: class ID in its segment
     '''
-    # segment folder
-    target_path = os.path.join(OUTPUT_ROOT_PATH, orig_data_rec[0])
-    if not os.path.exists(target_path):
-        os.mkdir(target_path)
-    # class folder
-    target_path = os.path.join(target_path, '{}'.format(klass))
-    if not os.path.exists(target_path):
-        os.mkdir(target_path)
-    # end point path
-    target_path = os.path.join(target_path,
-                               '{}.{}'.format(orig_data_rec.name, format))
-    # dump to file
-    with open(target_path, 'wb') as of:
-        of.write(base64.b64decode(orig_data_rec[6]))
+    image_writer.write_record(orig_data_rec.segment, klass,
+                              orig_data_rec.idx, orig_data_rec.image,
+                              format=format)
+
+
+''' Segment Databases '''
+
+
+class SegmentPool(object):
+    '''
+    LRU cache of open segment databases, along with their prototypes
+
+    Switching segments used to close one database, then open (and
+    `CREATE TABLE`) the next and load its classes, which is costly when
+    segments interleave or straddle chunks. Here up to `capacity` segments
+    are kept open with their `PrototypeMatrix`, and their changes are only
+    committed by `flush()` at checkpoints, or when evicted.
+
+    Usage::
+
+        with SegmentPool() as segment_pool:
+            seg_connection, prototypes = segment_pool.get(top_db_cursor,
+                                                          segment)
+            ...
+            segment_pool.flush()    # before saving a breakpoint
+
+    On error, open segments are closed without committing.
+    '''
+
+    def __init__(self, capacity=1):
+        self.capacity = capacity
+        self._segments = OrderedDict()
+
+    def get(self, top_db_cursor, segment):
+        '''
+        Return:
+            `(seg_connection, prototypes)` of `segment`, opened if not yet
+        '''
+        entry = self._segments.get(segment)
+        if entry is not None:
+            self._segments.move_to_end(segment)
+            return entry
+        if len(self._segments) >= self.capacity:
+            _, evicted = self._segments.popitem(last=False)
+            self._close(*evicted)
+        seg_connection = connect(get_segment_db_path(segment))
+        create_seen_classes(seg_connection)
+        # build prototype matrix of the segment, it's held in memory until
+        # written back on flush or eviction
+        prototypes = load_prototypes(top_db_cursor, seg_connection.cursor())
+        entry = self._segments[segment] = (seg_connection, prototypes)
+        return entry
+
+    @staticmethod
+    def _close(seg_connection, prototypes, save=True):
+        if save and prototypes.changed:
+            save_prototypes(seg_connection, prototypes)
+        seg_connection.close()
+
+    def flush(self):
+        '''
+        commit changes of all open segments
+        '''
+        for seg_connection, prototypes in self._segments.values():
+            if prototypes.changed:
+                save_prototypes(seg_connection, prototypes)
+
+    def close(self, save=True):
+        for entry in self._segments.values():
+            self._close(*entry, save=save)
+        self._segments.clear()
+
+    def __len__(self):
+        return len(self._segments)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(save=exc_type is None)
 
 
 ''' Processes '''
 
 
-def record_process(top_db_cursor, seg_cursor, orig_rec):
+def get_single_encoding(chunk_encodings, idx):
     '''
-    individual record process
+    get the face encoding of a record, if it has exactly one face
 
     Args:
-        `top_db_cursor`: top-level database cursor
-        `seg_cursor`: segment database cursor
-        `orig_rec`: original data read by `pandas`
+        `chunk_encodings`: `{ id: blob }` prefetched for the current chunk
+        `idx`: record id
+
+    Return:
+        `(count, encoding)`, `count` being `None` if record not in database,
+        and `encoding` being `None` unless `count == 1`
     '''
-    idx = orig_rec.name
-    print('Processing {}...'.format(idx))
     # get encoding record
-    top_db_cursor.execute(
-        '''
-        SELECT * FROM encodings
-        WHERE
-            id = ?
-        ''',
-        (idx,)
-    )
-    record = top_db_cursor.fetchone()
-    if record is None:
+    blob = chunk_encodings.get(idx)
+    if blob is None:
         print('Not found in database, uncached record!')
-        return
+        return None, None
     # get encodings list data
-    encoding = get_encoding_from_record(record)
-    top_db_cursor.execute(
-        '''
-        UPDATE encodings
-        SET
-            count = ?
-        WHERE
-            id = ?
-        ''',
-        (len(encoding), idx)
-    )
+    encoding = unpack_encodings(blob, encoding_format)
+    count = len(encoding)
     # encodings count validation
-    if len(encoding) != 1:
-        print('{} faces detected in {}, skipping...'
-              .format(len(encoding), idx))
-        return
-    encoding = encoding[0]
-    # find its class id
-    found_match = False
-    klasses = get_class_list_order_by_count(seg_cursor)
-    for klass in klasses:
-        if fr.compare_faces(
-                    get_encoding_in_class(top_db_cursor,
-                                          seg_cursor,
-                                          klass),
-                    encoding,
-                    tolerance=0.55      # TODO: TUNE THIS!!!
-                )[0]:
-            found_match = True
-            target_klass = klass
-            # register in stat table
-            increase_class_count(seg_cursor, klass)
-    if not found_match:
-        # HACK: if class IDs are `0`-indexed, and no deletions are
-        #       applied, they would be sequential naturally in this
-        #       fashion
-        target_klass = len(klasses)
-        new_class_stat(seg_cursor, target_klass, idx)
+    if count != 1:
+        print('{} faces detected in {}, skipping...'.format(count, idx))
+        return count, None
+    return count, encoding[0]
+
+
+def classify_encoding(prototypes, encoding, idx, new_klass):
+    '''
+    find class of `encoding` against all prototypes at once, registering a
+    new class `new_klass` if none matches
+
+    Return:
+        class ID
+    '''
+    row = prototypes.match(encoding, TOLERANCE)
+    if row is not None:
+        prototypes.hit(row, encoding, EMA_TAU)
+        return int(prototypes.klasses[row])
+    prototypes.add(new_klass, encoding, idx)
+    return new_klass
+
+
+def record_process(chunk_encodings, prototypes, orig_rec):
+    '''
+    individual record process
+
+    NOTE: Class stats are only changed in `prototypes`, call
+          `save_prototypes()` to persist them!
+
+    Args:
+        `chunk_encodings`: `{ id: blob }` prefetched for the current chunk
+        `prototypes`: `PrototypeMatrix` of current segment
+        `orig_rec`: original data record, see `tsv_reader.py`
+
+    Return:
+        number of faces in record, `None` if record not in database
+    '''
+    idx = orig_rec.idx
+    print('Processing {}...'.format(idx))
+    count, encoding = get_single_encoding(chunk_encodings, idx)
+    if encoding is None:
+        return count
+    # HACK: if class IDs are `0`-indexed, and no deletions are
+    #       applied, they would be sequential naturally in this
+    #       fashion
+    target_klass = classify_encoding(prototypes, encoding, idx,
+                                     len(prototypes))
     # dump to file
     dump_to_folder(orig_rec, target_klass)
+    return count
 
 
-def chunk_process(top_db_connection, chunk, last_breakpoint):
+def chunk_process(top_db_connection, chunk, last_breakpoint,
+                  chunk_encodings=None, classified_segments=()):
+    '''
+    classify a chunk segment by segment, dumping images into class folders
+
+    Args:
+        `top_db_connection`: top-level database connection
+        `chunk`: chunk of records with `segment` and `image`
+        `last_breakpoint`: breakpoint to skip chunks until
+        `chunk_encodings`: `{ id: blob }` of the chunk if already at hand
+            (see `pipeline.py`), fetched from database if `None`
+        `classified_segments`: segments to skip records of, as classified
+            whole by `parallel_main()` or `coordinated_main()`, see
+            `load_classified_segments()`
+    '''
     print('Processing chunk {} - {}...'
-          .format(chunk.iloc[0].name, chunk.iloc[-1].name))
-    if last_breakpoint > chunk.iloc[-1].name:
+          .format(chunk[0].idx, chunk[-1].idx))
+    if last_breakpoint > chunk[-1].idx:
         print('Skipping this chunk: already processed...')
         return
     top_db_cursor = top_db_connection.cursor()
+    # prefetch encodings of the whole chunk in one range query
+    if chunk_encodings is None:
+        chunk_encodings = fetch_range(top_db_cursor,
+                                      chunk[0].idx, chunk[-1].idx)
+    face_counts = []
+    # segments stay open across chunks in `segment_pool`, or just for this
+    # chunk if there's none
+    pool = segment_pool if segment_pool is not None else SegmentPool()
     last_seg = 'some random text that would never appear as face id'
-    seg_connection = None
-    for _, orig_rec in chunk.iterrows():
+    prototypes = None
+    for orig_rec in chunk:
         # manage segment database connection
         # NOTE: Performance: you have to keep `sqlite3.commit()` called as few
         #       as possible, therefore database connections must be kept
         #       accross record processes!
-        current_seg = orig_rec[0]
-        # check if need to change segment database connection
-        if last_seg != current_seg:     # segment changed (or no previous connection)
-            # commit changes if there is a previous connection
-            if seg_connection is not None:
-                seg_connection.commit()
-                seg_connection.close()
-            # open new segment database connection
-            seg_db_path = os.path.join(SEGMENT_DB_DIR,
-                                       '{}.db'.format(current_seg))
-            seg_connection = sqlite3.connect(seg_db_path)
-            seg_connection.execute(
-                '''
-                CREATE TABLE IF NOT EXISTS seen_classes (
-                    belong      integer     primary key     ,
-                    first_id    integer     not null unique ,
-                    count       integer     not null        )
-                '''
-            )
-        seg_cursor = seg_connection.cursor()
-        record_process(top_db_cursor, seg_cursor, orig_rec)
+        current_seg = orig_rec.segment
+        if current_seg in classified_segments:
+            continue
+        # check if need to change segment (or no previous one), switching
+        # back to a segment still open is nearly free
+        if last_seg != current_seg:
+            _, prototypes = pool.get(top_db_cursor, current_seg)
+        count = record_process(chunk_encodings, prototypes, orig_rec)
+        if count is not None:
+            face_counts.append((count, orig_rec.idx))
         last_seg = current_seg
-    # close segment connection
-    seg_connection.commit()
-    seg_connection.close()
-    # save checkpoint at top-level database
-    top_db_connection.commit()
-    breakpoint = chunk.iloc[-1].name
+    # commit classes of segments changed, before the breakpoint
+    if pool is segment_pool:
+        pool.flush()
+    else:
+        pool.close()
+    # register face counts of the chunk
+    save_face_counts(top_db_cursor, face_counts)
+    # save checkpoint at top-level database, after images hit the disk, in a
+    # single commit along with face counts
+    image_writer.flush()
+    breakpoint = chunk[-1].idx
     save_breakpoint(top_db_connection, breakpoint)
+    top_db_connection.commit()
     return breakpoint
 
 
-''' Main '''
+def global_chunk_process(top_db_connection, prototypes, chunk,
+                         last_breakpoint, chunk_encodings=None):
+    '''
+    classify a chunk across the entire dataset, ignoring segments
+
+    This is the non-segment version described in README: `seen_classes`
+    lives in the top-level database, a global clock ticks once per record,
+    and every `PRUNE_INTERVAL` ticks classes rarer than `PRUNE_MIN_RATE` are
+    dropped to keep the compare set bounded. Nothing is dumped, results go to
+    the `belong` column instead, see `dump_folders.py`.
+
+    Args:
+        `top_db_connection`: top-level database connection
+        `prototypes`: global `PrototypeMatrix`
+        `chunk`: chunk of records, only `idx` is used
+        `last_breakpoint`: breakpoint to skip chunks until
+        `chunk_encodings`: see `chunk_process()`
+    '''
+    print('Processing chunk {} - {}...'
+          .format(chunk[0].idx, chunk[-1].idx))
+    if last_breakpoint > chunk[-1].idx:
+        print('Skipping this chunk: already processed...')
+        return
+    top_db_cursor = top_db_connection.cursor()
+    if chunk_encodings is None:
+        chunk_encodings = fetch_range(top_db_cursor,
+                                      chunk[0].idx, chunk[-1].idx)
+    face_counts, belongs = [], []
+    for orig_rec in chunk:
+        idx = orig_rec.idx
+        print('Processing {}...'.format(idx))
+        count, encoding = get_single_encoding(chunk_encodings, idx)
+        if count is not None:
+            face_counts.append((count, idx))
+        if encoding is not None:
+            # NOTE: class ID is the record ID of its first member, so IDs of
+            #       pruned classes are never reused
+            klass = classify_encoding(prototypes, encoding, idx, idx)
+            belongs.append((klass, idx))
+        # global clock is the record ID
+        if (idx + 1) % PRUNE_INTERVAL == 0:
+            pruned = prototypes.prune(idx + 1, PRUNE_MIN_RATE,
+                                      PRUNE_INTERVAL)
+            print('Clock {}: pruned {} classes, {} left.'
+                  .format(idx + 1, pruned, len(prototypes)))
+    save_face_counts(top_db_cursor, face_counts)
+    save_belongs(top_db_cursor, belongs)
+    breakpoint = chunk[-1].idx
+    save_breakpoint(top_db_connection, breakpoint, 'global_breakpoints')
+    # commits all of the above along with classes
+    save_prototypes(top_db_connection, prototypes)
+    return breakpoint
 
 
-def main():
+def read_segment(index, segment, idxes):
+    '''
+    records of a segment, read by seeking with `index`, in chunks of
+    `CHUNK_SIZE`
+    '''
+    Record = get_record_type(('segment', 'image'))
+    image_column = COLUMNS['image']
+    for start in range(0, len(idxes), CHUNK_SIZE):
+        yield [Record(int(idx), segment, index.read_record(idx)[image_column])
+               for idx in idxes[start:start + CHUNK_SIZE]]
 
-    orig_reader = pd.read_csv(ORIGINAL_DATA_PATH,
-                              sep='\t', header=None,
-                              chunksize=CHUNK_SIZE)
 
-    last_breakpoint = load_breakpoint()
+def classify_segment(top_db_cursor, index, segment, idxes, heartbeat=None):
+    '''
+    classify all records of a segment from scratch, dumping images into
+    class folders
+
+    Classes are committed to the segment database once at the end, and a
+    segment classified again starts over, writing the very same classes and
+    files, so a whole segment is the unit of progress instead of a
+    breakpoint.
+
+    Args:
+        `top_db_cursor`: top-level database cursor, only read from
+        `index`: `TsvIndex` of original data
+        `segment`: segment id
+        `idxes`: record ids of the segment, see `TsvIndex.segment_records()`
+        `heartbeat`: called after each chunk, e.g. `Lease.heartbeat()`
 
-    with sqlite3.connect(TOP_DB_PATH) as top_db_connection:
+    Return:
+        `[ (count, id) ]` face counts to save, see `save_face_counts()`
+    '''
+    print('Processing segment {} ({} records)...'
+          .format(segment, len(idxes)))
+    remove_segment_db(segment)
+    seg_connection = connect(get_segment_db_path(segment), **get_pragmas())
+    try:
+        create_seen_classes(seg_connection)
+        prototypes = load_prototypes(top_db_cursor, seg_connection.cursor())
+        face_counts = []
+        for chunk in read_segment(index, segment, idxes):
+            # a range query would also read records of other segments in
+            # between, when records of the segment are scattered
+            if chunk[-1].idx - chunk[0].idx + 1 > len(chunk):
+                chunk_encodings = fetch_ids(top_db_cursor,
+                                            [rec.idx for rec in chunk])
+            else:
+                chunk_encodings = fetch_range(top_db_cursor,
+                                              chunk[0].idx, chunk[-1].idx)
+            for orig_rec in chunk:
+                count = record_process(chunk_encodings, prototypes, orig_rec)
+                if count is not None:
+                    face_counts.append((count, orig_rec.idx))
+            if heartbeat is not None:
+                heartbeat()
+        image_writer.flush()
+        save_prototypes(seg_connection, prototypes)
+    finally:
+        seg_connection.close()
+    return face_counts
+
+
+def segment_process(top_db_connection, index, segment, idxes,
+                    heartbeat=None):
+    '''
+    `classify_segment()` and commit its face counts, along with the segment
+    in `classified_segments`
+
+    Args:
+        `top_db_connection`: top-level database connection
+        see `classify_segment()` for the rest
+    '''
+    top_db_cursor = top_db_connection.cursor()
+    face_counts = classify_segment(top_db_cursor, index, segment, idxes,
+                                   heartbeat)
+    # make sure the segment is still ours right before committing
+    if heartbeat is not None:
+        heartbeat()
+    save_face_counts(top_db_cursor, face_counts)
+    save_classified_segment(top_db_cursor, segment)
+    top_db_connection.commit()
+
+
+''' Parallel Segment Process '''
+
+# settings workers take from the parent, whatever the start method
+WORKER_SETTINGS = ('ORIGINAL_DATA_PATH', 'CHUNK_SIZE', 'TOP_DB_PATH',
+                   'SEGMENT_DB_DIR', 'OUTPUT_ROOT_PATH', 'TOLERANCE',
+                   'EMA_TAU', 'USE_ANN_INDEX', 'encoding_format')
+
+# per worker state, set up by `_init_worker()`
+_index = None
+_top_db_connection = None
+
+
+def _init_worker(settings):
+    '''
+    worker initializer, opens the index, a read-only top-level database
+    connection and an image writer exactly once
+    '''
+    global _index, _top_db_connection, image_writer
+    globals().update(settings)
+    _index = TsvIndex.load(ORIGINAL_DATA_PATH)
+    _top_db_connection = connect(TOP_DB_PATH)
+    image_writer = open_image_writer(OUTPUT_ROOT_PATH, 'folders')
+
+
+def _classify_segment_job(job):
+    segment, idxes = job
+    return segment, classify_segment(_top_db_connection.cursor(), _index,
+                                     segment, idxes)
+
+
+def create_classified_segments(db_connection):
+    db_connection.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS classified_segments (
+            segment     text        primary key
+        )'''
+    )
+    db_connection.commit()
+
+
+def save_classified_segment(top_db_cursor, segment):
+    '''
+    record a segment classified whole, not committed, so that it lands in the
+    same commit as its face counts
+    '''
+    top_db_cursor.execute(
+        'INSERT OR IGNORE INTO classified_segments (segment) VALUES (?)',
+        (segment,))
+
+
+def load_classified_segments(db_connection):
+    '''
+    Return:
+        set of segments classified whole by `parallel_main()` or
+        `coordinated_main()`
+    '''
+    create_classified_segments(db_connection)
+    return set(row[0] for row in db_connection.execute(
+        'SELECT segment FROM classified_segments'))
+
+
+def parallel_main(processes):
+    '''
+    classify whole segments on a pool of `processes` workers
+
+    Segments never interact, so each worker owns the segment databases and
+    class folders of the segments it is handed, reading their records by
+    seeking. Face counts come back to this process, which saves them in bulk
+    with group commits, along with the segments done in table
+    `classified_segments`, so a rerun only classifies segments not done yet,
+    and `main()` skips them instead of classifying their records once more.
+    '''
+    global encoding_format
+    if OUTPUT_MODE != 'folders':
+        raise RuntimeError('Parallel classification only supports '
+                           '\'folders\' output!')
+    index = TsvIndex.load(ORIGINAL_DATA_PATH)
+    if index is None:
+        raise RuntimeError('Parallel classification requires an index, run '
+                           '`tsv_index.py`!')
+    if not os.path.exists(SEGMENT_DB_DIR):
+        os.makedirs(SEGMENT_DB_DIR)
+    with connect(TOP_DB_PATH) as top_db_connection:
+        top_db_cursor = top_db_connection.cursor()
+        encoding_format = get_encoding_format(top_db_cursor)
+        done = load_classified_segments(top_db_connection)
+        jobs = [(segment, idxes)
+                for segment, idxes in index.segment_records().items()
+                if segment not in done]
+        index.close()
+        # largest segments first, so that no worker is left alone with a
+        # huge one in the end
+        jobs.sort(key=lambda job: len(job[1]), reverse=True)
+        print('{} segments to classify, {} done before.'
+              .format(len(jobs), len(done)))
+        settings = {name: globals()[name] for name in WORKER_SETTINGS}
+        group_commit = GroupCommit(top_db_connection)
+        try:
+            with mp.Pool(processes=processes, initializer=_init_worker,
+                         initargs=(settings,)) as pool:
+                for segment, face_counts in pool.imap_unordered(
+                        _classify_segment_job, jobs,
+                        chunksize=SEGMENTS_PER_TASK):
+                    save_face_counts(top_db_cursor, face_counts)
+                    save_classified_segment(top_db_cursor, segment)
+                    group_commit.add(len(face_counts) + 1)
+            group_commit.commit()
+        except KeyboardInterrupt:
+            group_commit.commit()
+            print('Breaked manually!')
+
+
+''' Staged Reading '''
+
+def read_ahead(orig_reader):
+    '''
+    chunks along with their encodings, for `prefetch()`
+
+    Runs in the reader thread, thus opens a connection of its own. Only
+    `count` and `belong` are written while classifying, so encodings fetched
+    ahead never go stale.
+    '''
+    with connect(TOP_DB_PATH) as top_db_connection:
+        top_db_cursor = top_db_connection.cursor()
         for chunk in orig_reader:
-            chunk_process(top_db_connection, chunk, last_breakpoint)
+            yield chunk, fetch_range(top_db_cursor,
+                                     chunk[0].idx, chunk[-1].idx)
+
+
+def get_item_bytes(item):
+    chunk, chunk_encodings = item
+    size = sum(map(len, chunk_encodings.values()))
+    if 'image' in chunk[0]._fields:
+        size += sum(len(rec.image) for rec in chunk)
+    return size
+
+
+''' Main '''
+
+
+def coordinated_main():
+    '''
+    classify segments leased from the coordinator, until all are done
+    '''
+    global encoding_format, image_writer
+    if OUTPUT_MODE != 'folders':
+        raise RuntimeError('Coordinated classification only supports '
+                           '\'folders\' output!')
+    index = TsvIndex.load(ORIGINAL_DATA_PATH)
+    if index is None:
+        raise RuntimeError('Coordination requires an index, run '
+                           '`tsv_index.py`!')
+    segment_records = index.segment_records()
+    if not os.path.exists(SEGMENT_DB_DIR):
+        os.makedirs(SEGMENT_DB_DIR)
+    coordinator = Coordinator(COORDINATOR_PATH, WORKER_ID)
+    try:
+        with connect(TOP_DB_PATH, **get_pragmas()) as top_db_connection, \
+                open_image_writer(OUTPUT_ROOT_PATH,
+                                  OUTPUT_MODE) as image_writer:
+            encoding_format = get_encoding_format(top_db_connection.cursor())
+            create_classified_segments(top_db_connection)
+            for lease in coordinator.leases('classify'):
+                try:
+                    segment_process(top_db_connection, index, lease.segment,
+                                    segment_records[lease.segment],
+                                    lease.heartbeat)
+                except LeaseLost as e:
+                    top_db_connection.rollback()
+                    print(e)
+                    continue
+                if not lease.done():
+                    print('Segment {} was leased to another worker meanwhile, '
+                          'left to it.'.format(lease.segment))
+    finally:
+        coordinator.close()
+        index.close()
+
+
+def main(global_mode=False):
+
+    breakpoints_table = 'global_breakpoints' if global_mode else 'breakpoints'
+    last_breakpoint = load_breakpoint(breakpoints_table)
+
+    global encoding_format, image_writer, segment_pool
+
+    # NOTE: breakpoint is the last record of a finished chunk, `0` for none
+    start = last_breakpoint + 1 if last_breakpoint else 0
+    # global mode dumps nothing, thus needs no image
+    columns = ('segment',) if global_mode else ('segment', 'image')
+    orig_reader = iter_chunks(ORIGINAL_DATA_PATH, columns=columns,
+                              start=start, chunksize=CHUNK_SIZE)
+    if STAGED:
+        orig_reader = prefetch(read_ahead(orig_reader), get_item_bytes,
+                               QUEUE_BYTES)
+    else:
+        orig_reader = ((chunk, None) for chunk in orig_reader)
+
+    if global_mode:
+        with connect(TOP_DB_PATH) as top_db_connection:
+            top_db_cursor = top_db_connection.cursor()
+            encoding_format = get_encoding_format(top_db_cursor)
+            create_seen_classes(top_db_connection)
+            prototypes = load_prototypes(top_db_cursor, top_db_cursor)
+            for chunk, chunk_encodings in orig_reader:
+                global_chunk_process(top_db_connection, prototypes, chunk,
+                                     last_breakpoint, chunk_encodings)
+        return
+
+    with connect(TOP_DB_PATH) as top_db_connection, \
+            open_image_writer(OUTPUT_ROOT_PATH, OUTPUT_MODE) as image_writer, \
+            SegmentPool(SEGMENT_POOL_SIZE) as segment_pool:
+        encoding_format = get_encoding_format(top_db_connection.cursor())
+        # segments of a previous `--processes` or `--coordinate` run are
+        # done already
+        classified_segments = load_classified_segments(top_db_connection)
+        for chunk, chunk_encodings in orig_reader:
+            chunk_process(top_db_connection, chunk, last_breakpoint,
+                          chunk_encodings, classified_segments)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='''Classify faces in each segment, or across the entire
+dataset with `--global`.'''
+    )
+    parser.add_argument('--global', dest='global_mode', action='store_true',
+                        help='''Non-segment mode: keep `seen_classes` in the
+top-level database, prune rare classes periodically, and write results to
+`belong` instead of dumping images.''')
+    parser.add_argument('--prune-interval', type=int, default=PRUNE_INTERVAL,
+                        help='''Records between two prunings (global mode).''')
+    parser.add_argument('--prune-rate', type=float, default=PRUNE_MIN_RATE,
+                        help='''Minimum members per record since a class is
+created for it to survive pruning (global mode).''')
+    parser.add_argument('--ann', action='store_true',
+                        help='''Match against an approximate nearest-neighbour
+index of prototypes, for global mode or huge segments.''')
+    parser.add_argument('--ema-tau', type=float, default=EMA_TAU,
+                        help='''Update class prototypes as running averages
+with this weight of new members, `0` keeps the first member.''')
+    parser.add_argument('--staged', action='store_true',
+                        help='''Read chunks and fetch their encodings in a
+background thread while classifying.''')
+    parser.add_argument('--queue-mb', type=int, default=QUEUE_BYTES >> 20,
+                        help='''Megabytes of chunks read ahead with
+`--staged`.''')
+    parser.add_argument('--segment-pool', type=int, default=SEGMENT_POOL_SIZE,
+                        help='''Segment databases kept open across records
+and chunks, committed at checkpoints only.''')
+    parser.add_argument('-p', '--processes', type=int,
+                        default=PROCESSES_COUNT,
+                        help='''Classify whole segments on a pool of this many
+processes, each owning the databases and folders of its segments. Requires
+`tsv_index.py` to be run first.''')
+    parser.add_argument('--coordinate', action='store_true',
+                        help='''Classify whole segments leased from the
+coordinator until all are done, see `coordinator.py`.''')
+    parser.add_argument('--coordinator', default=COORDINATOR_PATH,
+                        help='''Coordinator database.''')
+    parser.add_argument('--worker-id',
+                        help='''Name of this worker, `<host>-<pid>` by
+default.''')
+    args = parser.parse_args()
+    STAGED = args.staged
+    COORDINATE = args.coordinate
+    COORDINATOR_PATH = args.coordinator
+    WORKER_ID = args.worker_id
+    PROCESSES_COUNT = args.processes
+    SEGMENT_POOL_SIZE = args.segment_pool
+    if PROCESSES_COUNT > 1 and (args.global_mode or COORDINATE):
+        parser.error('`--processes` only applies to segment mode')
+    QUEUE_BYTES = args.queue_mb << 20
+    EMA_TAU = args.ema_tau
+    USE_ANN_INDEX = args.ann
+    PRUNE_INTERVAL = args.prune_interval
+    PRUNE_MIN_RATE = args.prune_rate
+
     print('Staring...')
-    main()
+    if COORDINATE:
+        coordinated_main()
+    elif PROCESSES_COUNT > 1:
+        parallel_main(PROCESSES_COUNT)
+    else:
+        main(global_mode=args.global_mode)
     print('All Done!')
 
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Lease-based work distribution, for several workers (on one host, or several
+hosts sharing a filesystem) running over one dataset.
+
+A single breakpoint can't tell which parts of the data several workers are
+on. Instead, a job is planned as work units in table `work_units` of
+`coordinator.db`::
+
+    work_units (
+        job             text    ,   -- 'extract' or 'classify'
+        unit            integer ,   -- unit number within job
+        first, last     integer ,   -- records `first <= idx <= last`
+        offset, size    integer ,   -- bytes of those records in `.tsv`
+        segment         text    ,   -- segment id of 'classify' units
+        state           text    ,   -- 'pending', 'leased' or 'done'
+        owner           text    ,   -- worker holding the lease
+        lease_expires   real    ,   -- `time.time()` the lease runs out
+        attempts        integer     -- times leased
+    )
+
+'extract' units are byte-balanced ranges of records, 'classify' units are
+whole segments (see `classify_faces.segment_process()`). A worker claims a
+unit, which leases it for `LEASE_SECONDS`, renews the lease with
+`heartbeat()` while processing, and finally marks it done. Units whose lease
+expired (the worker crashed or hung) are leased again to the next worker
+asking. Processing a unit must therefore be idempotent, which both
+`extract_to_db.py` and `classify_faces.py` are: records already extracted
+are skipped, and a segment is classified over from scratch.
+
+Plan jobs with an index (see `tsv_index.py`), then start workers anywhere::
+
+    python coordinator.py plan extract [--unit-mb 1024]
+    python coordinator.py plan classify
+    python extract_to_db.py --coordinate [-p N]     # on every host
+    python merge_shards.py                          # once all done
+    python classify_faces.py --coordinate           # on every host
+    python coordinator.py status
+
+NOTE: SQLite in WAL mode needs shared memory, which doesn't work across
+      hosts, so shared databases (`coordinator.db`, and `encodings.db` of
+      classification workers) are opened with `storage.SHARED_PRAGMAS`.
+      Leases are compared against `time.time()` of each host, keep their
+      clocks in sync (e.g. NTP) well within `LEASE_SECONDS`.
+'''
+
+import os
+import time
+import socket
+import argparse
+
+import numpy as np
+
+from tsv_index import TsvIndex
+from storage import SHARED_PRAGMAS, connect
+
+
+''' Configurations '''
+
+COORDINATOR_PATH = os.path.join(os.curdir, 'coordinator.db')
+ORIGINAL_DATA_PATH = '../FaceImageCroppedWithoutAlignment.tsv'
+
+JOBS = ('extract', 'classify')
+# bytes of `.tsv` per 'extract' unit
+UNIT_BYTES = 1 << 30
+# a unit not heartbeated for this long is leased to another worker
+LEASE_SECONDS = 600.
+# how long idle workers wait before asking again, while units are leased
+POLL_SECONDS = 30.
+
+
+''' Exceptions '''
+
+class LeaseLost(Exception):
+    '''
+    raised by `Lease.heartbeat()` when the unit was leased to another worker
+    '''
+
+
+''' Planning '''
+
+def create_units_table(db_connection):
+    db_connection.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS work_units (
+            job             text        not null        ,
+            unit            integer     not null        ,
+            first           integer     not null        ,
+            last            integer     not null        ,
+            offset          integer                     ,
+            size            integer                     ,
+            segment         text                        ,
+            state           text        not null        default 'pending',
+            owner           text                        ,
+            lease_expires   real                        ,
+            attempts        integer     not null        default 0,
+            primary key (job, unit)
+        )'''
+    )
+    db_connection.execute(
+        '''
+        CREATE INDEX IF NOT EXISTS work_units_state
+            ON work_units (job, state, lease_expires)
+        '''
+    )
+    db_connection.commit()
+
+
+def plan_ranges(index, unit_bytes=UNIT_BYTES):
+    '''
+    split records into ranges of about `unit_bytes` bytes each
+
+    Return:
+        `[ (first, last, offset, size, None) ]`
+    '''
+    if not len(index):
+        return []
+    offsets = index.offsets
+    total = int(offsets[-1])
+    firsts = np.unique(np.searchsorted(
+        offsets[:-1], np.arange(0, total, unit_bytes, dtype=np.uint64)))
+    lasts = np.append(firsts[1:], len(index)) - 1
+    return [(int(first), int(last), int(offsets[first]),
+             int(offsets[last + 1] - offsets[first]), None)
+            for first, last in zip(firsts, lasts)]
+
+
+def plan_segments(index):
+    '''
+    one unit per segment
+
+    Return:
+        `[ (first, last, None, records, segment) ]`
+    '''
+    return [(int(idxes[0]), int(idxes[-1]), None, len(idxes), segment)
+            for segment, idxes in index.segment_records().items()]
+
+
+''' Coordinator '''
+
+class Lease(object):
+    '''
+    a unit leased to a worker
+    '''
+
+    def __init__(self, coordinator, job, unit, first, last, segment,
+                 attempts):
+        self.coordinator = coordinator
+        self.job = job
+        self.unit = unit
+        self.first = first
+        self.last = last
+        self.segment = segment
+        self.attempts = attempts
+
+    def heartbeat(self):
+        '''
+        renew the lease, raises `LeaseLost` if it was leased to another
+        worker meanwhile
+        '''
+        if not self.coordinator.renew(self):
+            raise LeaseLost('Unit {} of \'{}\' was leased to another worker!'
+                            .format(self.unit, self.job))
+
+    def done(self):
+        '''
+        Return:
+            `False` if the unit was leased to another worker meanwhile
+        '''
+        return self.coordinator.finish(self)
+
+    def __repr__(self):
+        return 'Lease({}, unit {}, records {}-{}{})'.format(
+            self.job, self.unit, self.first, self.last,
+            ', segment {}'.format(self.segment) if self.segment else '')
+
+
+class Coordinator(object):
+    '''
+    work units of jobs in a shared database
+
+    Usage::
+
+        coordinator = Coordinator(path, owner)
+        for lease in coordinator.leases('extract'):
+            for chunk in ...:
+                ...                 # process
+                lease.heartbeat()
+            lease.heartbeat()
+            ...                     # commit results
+            lease.done()
+    '''
+
+    def __init__(self, path=COORDINATOR_PATH, owner=None,
+                 lease_seconds=LEASE_SECONDS):
+        self.owner = owner or get_worker_id()
+        self.lease_seconds = lease_seconds
+        self.db_connection = connect(path, **SHARED_PRAGMAS)
+        create_units_table(self.db_connection)
+
+    def close(self):
+        self.db_connection.close()
+
+    def plan(self, job, units):
+        '''
+        insert units of `job`, unless already planned
+
+        Args:
+            `units`: `[ (first, last, offset, size, segment) ]`
+
+        Return:
+            number of units inserted
+        '''
+        c = self.db_connection.cursor()
+        c.execute('SELECT COUNT(*) FROM work_units WHERE job = ?', (job,))
+        if c.fetchone()[0]:
+            return 0
+        c.executemany(
+            '''
+            INSERT INTO work_units
+                (job, unit, first, last, offset, size, segment)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''',
+            ((job, unit) + tuple(row) for unit, row in enumerate(units))
+        )
+        self.db_connection.commit()
+        return len(units)
+
+    def drop(self, job):
+        self.db_connection.execute('DELETE FROM work_units WHERE job = ?',
+                                   (job,))
+        self.db_connection.commit()
+
+    def claim(self, job):
+        '''
+        lease the first pending (or expired) unit of `job`
+
+        Return:
+            `Lease`, or `None` if no unit is available right now
+        '''
+        now = time.time()
+        c = self.db_connection.cursor()
+        # take the write lock up front, so that no two workers could select
+        # the same unit
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            c.execute(
+                '''
+                SELECT unit, first, last, segment, attempts FROM work_units
+                WHERE
+                    job = ? AND (state = 'pending'
+                                 OR (state = 'leased' AND lease_expires < ?))
+                ORDER BY unit
+                LIMIT 1
+                ''',
+                (job, now)
+            )
+            row = c.fetchone()
+            if row is None:
+                self.db_connection.commit()
+                return None
+            unit, first, last, segment, attempts = row
+            c.execute(
+                '''
+                UPDATE work_units
+                SET
+                    state = 'leased', owner = ?, lease_expires = ?,
+                    attempts = attempts + 1
+                WHERE
+                    job = ? AND unit = ?
+                ''',
+                (self.owner, now + self.lease_seconds, job, unit)
+            )
+            self.db_connection.commit()
+        except BaseException:
+            self.db_connection.rollback()
+            raise
+        return Lease(self, job, unit, first, last, segment, attempts + 1)
+
+    def renew(self, lease):
+        '''
+        Return:
+            `False` if the lease is no longer held
+        '''
+        c = self.db_connection.execute(
+            '''
+            UPDATE work_units
+            SET
+                lease_expires = ?
+            WHERE
+                job = ? AND unit = ? AND owner = ? AND state = 'leased'
+            ''',
+            (time.time() + self.lease_seconds, lease.job, lease.unit,
+             self.owner)
+        )
+        self.db_connection.commit()
+        return c.rowcount == 1
+
+    def finish(self, lease):
+        '''
+        mark a unit done, unless leased to another worker meanwhile
+
+        Return:
+            `False` if the lease is no longer held
+        '''
+        c = self.db_connection.execute(
+            '''
+            UPDATE work_units
+            SET
+                state = 'done', lease_expires = NULL
+            WHERE
+                job = ? AND unit = ? AND owner = ? AND state = 'leased'
+            ''',
+            (lease.job, lease.unit, self.owner)
+        )
+        self.db_connection.commit()
+        return c.rowcount == 1
+
+    def count(self, job):
+        '''
+        Return:
+            `{ state: units }` of `job`
+        '''
+        return dict(self.db_connection.execute(
+            'SELECT state, COUNT(*) FROM work_units WHERE job = ? '
+            'GROUP BY state', (job,)))
+
+    def leases(self, job, poll_seconds=POLL_SECONDS):
+        '''
+        claim units of `job` one after another, until all are done
+
+        When nothing is claimable but units are still leased to others, wait
+        and ask again, so that units of a stalled worker are picked up once
+        their lease expires.
+        '''
+        while True:
+            lease = self.claim(job)
+            if lease is not None:
+                yield lease
+                continue
+            if not self.count(job).get('leased'):
+                return
+            time.sleep(poll_seconds)
+
+
+''' Helper Functions '''
+
+def get_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def get_status(coordinator, job):
+    counts = coordinator.count(job)
+    return '{}: {} done, {} leased, {} pending.'.format(
+        job, counts.get('done', 0), counts.get('leased', 0),
+        counts.get('pending', 0))
+
+
+''' Main '''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='''Plan work units and show progress of distributed
+jobs.''')
+    parser.add_argument('command', choices=('plan', 'status', 'drop'))
+    parser.add_argument('jobs', nargs='*',
+                        help='''Jobs among {}, all of them if
+omitted.'''.format(', '.join(JOBS)))
+    parser.add_argument('--db', default=COORDINATOR_PATH,
+                        help='''Coordinator database on the shared
+filesystem.''')
+    parser.add_argument('--tsv', default=ORIGINAL_DATA_PATH,
+                        help='''Original data, must be indexed.''')
+    parser.add_argument('--unit-mb', type=int, default=UNIT_BYTES >> 20,
+                        help='''Megabytes of `.tsv` per extraction
+unit.''')
+    args = parser.parse_args()
+    jobs = args.jobs or JOBS
+    for job in jobs:
+        if job not in JOBS:
+            parser.error('unknown job \'{}\''.format(job))
+
+    coordinator = Coordinator(args.db)
+    if args.command == 'plan':
+        index = TsvIndex.load(args.tsv)
+        if index is None:
+            raise RuntimeError('Planning requires an index, run '
+                               '`tsv_index.py`!')
+        for job in jobs:
+            units = plan_ranges(index, args.unit_mb << 20) \
+                if job == 'extract' else plan_segments(index)
+            planned = coordinator.plan(job, units)
+            if planned:
+                print('Planned {} units of \'{}\'.'.format(planned, job))
+            else:
+                print('\'{}\' already planned, `drop` it first to plan '
+                      'again.'.format(job))
+    elif args.command == 'drop':
+        for job in jobs:
+            coordinator.drop(job)
+            print('Dropped \'{}\'.'.format(job))
+    for job in jobs:
+        print(get_status(coordinator, job))
+    coordinator.close()
@@ -4,27 +4,35 @@ __author__ = 'Xiaoguang Zhu'
 
 ''''''
 
-import sqlite3
 import pickle
 
 # import io
-import base64
 # import matplotlib.image as mpimage
 
 # import numpy as np
-import pandas as pd
 
 import os
 
+from tsv_index import TsvIndex
+from tsv_reader import COLUMNS, iter_chunks
+from image_writer import open_image_writer
+from storage import connect
+
 
 ''' Configuration Variables '''
 
 BREAKPOINT_PATH = './bkpt'
 OUTPUT_DIR      = './output'
+OUTPUT_MODE     = 'folders'     # or `'packed'`, see `image_writer.py`
 ORIG_DATA_PATH  = '../FaceImageCroppedWithoutAlignment.tsv'
 DATABASE_PATH   = './encodings.db'
 
 CHUNK_SIZE      = int(1e3)
+# minimum members of a class to be dumped
+VALVE_FREQ      = 10
+
+# background image writer, created in main
+image_writer    = None
 
 
 ''' Session Control '''
@@ -59,103 +67,85 @@ def save_breakpoint(path=BREAKPOINT_PATH):
 
 ''' Helper Functions - Image '''
 
-def save_record_to_class_folder(
-        rec, klass, format='jpg',
-        root_path=OUTPUT_DIR):
+def save_record_to_class_folder(rec, klass, format='jpg'):
     '''
-    save record to corresponding classified folder
+    save record to corresponding classified folder under `OUTPUT_DIR`
 
     Args:
-        `rec`: `pandas`-read record
+        `rec`: original data record, see `tsv_reader.py`
         `klass`: class index of the record
         `format`: format of input image (will be used as output format too)
-        `root_path`: default output root directory
     '''
-    target_dir = os.path.join(root_path, str(klass))
-    if not os.path.exists(target_dir):
-        os.mkdir(target_dir)
-    target_path = os.path.join(target_dir, '{}.{}'.format(rec.name, format))
-    with open(target_path, 'wb') as f:
-        f.write(base64.b64decode(rec[6]))
+    image_writer.write_record(None, klass, rec.idx, rec.image, format=format)
 
 
-''' Helper Functions - Database '''
+''' Processes '''
 
-def get_class_of_record(db_cursor, rec):
+def fetch_regular_members(db_cursor, valve_freq=VALVE_FREQ, start=0):
     '''
-    retrieve class index of record from database
+    ids and classes of all records to be dumped, in one query
 
-    Args:
-        `db_cursor`: database cursor
-        `rec`: `pandas`-read record
-
-    Return:
-        class index of type `int` or `None` if not found
-    '''
-    db_cursor.execute('''
-        SELECT belong FROM encodings
-        WHERE
-            id = ?
-        ''', (rec.name,))
-    klass = db_cursor.fetchone()
-    if klass is None:   # `id` not found
-        print('Record with id {} not found in database!'
-              .format(rec.name))
-        return None
-    klass = klass[0]    # NOTE: could be `int` or `None``
-    return klass
-
-
-def check_if_class_regular(db_cursor, klass, valve_freq=10):
-    '''
-    checks if a class has sufficient members
+    A record is dumped if it is classified (i.e. single-face) and its class
+    has at least `valve_freq` members, joined once instead of queried per
+    row.
 
     Args:
         `db_cursor`: database cursor
-        `klass`: the index of the class to be checked
         `valve_freq`: minimum number of members to be considered *regular*
+        `start`: first record id to consider
 
     Return:
-        `True` if regular, else returns `False`
+        `[ (id, belong) ]` ordered by `id`
     '''
     db_cursor.execute('''
-        SELECT count FROM seen_classes
+        SELECT e.id, e.belong FROM encodings AS e
+            JOIN seen_classes AS s ON s.belong = e.belong
         WHERE
-            belong = ?
-        ''', (klass,))
-    count = db_cursor.fetchone()
-    if count is None:     # class entry deleted (for it's not frequent)
-        return False
-    count = count[0]
-    if count < valve_freq:
-        return False
-    return True
+            s.count >= ? AND e.id >= ?
+        ORDER BY e.id
+        ''', (valve_freq, start))
+    return db_cursor.fetchall()
 
 
-''' Processes '''
+def process_chunk(members, chunk):
+    '''
+    dump members in a chunk streamed from the `.tsv`, used when no index is
+    available
 
-def process_record(db_cursor, rec):
+    Args:
+        `members`: `{ id: belong }` of records to be dumped
+        `chunk`: chunk of records, see `tsv_reader.py`
+    '''
     global breakpoint
-    print('Processing {}...'.format(rec.name))
-    klass = get_class_of_record(db_cursor, rec)
-    if klass is not None \
-            and check_if_class_regular(db_cursor, klass):
-        save_record_to_class_folder(rec, klass)
-    else:
-        print('Face in record {} has count more than 1, '.format(rec.name)
-              + 'or of a rare class. Skipping...')
-    breakpoint += 1
-
-
-def process_chunk(db_connection, chunk):
     print('Starting with chunk {} - {}...'
-          .format(chunk.iloc[0].name, chunk.iloc[-1].name))
-    if breakpoint > chunk.iloc[-1].name:
+          .format(chunk[0].idx, chunk[-1].idx))
+    if breakpoint > chunk[-1].idx:
         print('Skipping this chunk for it\'s already processed!')
         return
-    db_cursor = db_connection.cursor()
-    for idx, rec in chunk.iterrows():
-        process_record(db_cursor, rec)
+    for rec in chunk:
+        klass = members.get(rec.idx)
+        if klass is not None:
+            save_record_to_class_folder(rec, klass)
+    breakpoint = chunk[-1].idx + 1
+    image_writer.flush()
+    save_breakpoint()
+
+
+def process_members(index, members):
+    '''
+    dump a batch of members, reading only their records with index seeks
+
+    Args:
+        `index`: `TsvIndex` of original data
+        `members`: `[ (id, belong) ]` ordered by `id`
+    '''
+    global breakpoint
+    print('Dumping records {} - {}...'.format(members[0][0], members[-1][0]))
+    for idx, klass in members:
+        payload = index.read_record(idx)[COLUMNS['image']]
+        image_writer.write_record(None, klass, idx, payload)
+    breakpoint = members[-1][0] + 1
+    image_writer.flush()
     save_breakpoint()
 
 
@@ -165,13 +155,24 @@ if __name__ == '__main__':
 
     load_breakpoint()
 
-    orig_reader = pd.read_csv(ORIG_DATA_PATH,
-                              sep='\t', header=None,
-                              chunksize=CHUNK_SIZE)
-
-    with sqlite3.connect(DATABASE_PATH) as db_connection:
-        for chunk in orig_reader:
-            process_chunk(db_connection, chunk)
-            print('Loading next chunk...')
+    with connect(DATABASE_PATH) as db_connection, \
+            open_image_writer(OUTPUT_DIR, OUTPUT_MODE) as image_writer:
+        members = fetch_regular_members(db_connection.cursor(),
+                                        start=breakpoint)
+        print('{} records of regular classes to dump.'.format(len(members)))
+        index = TsvIndex.load(ORIG_DATA_PATH)
+        if index is not None:
+            for i in range(0, len(members), CHUNK_SIZE):
+                process_members(index, members[i:i + CHUNK_SIZE])
+            index.close()
+        elif members:
+            # no index, stream until the last member, skipping nothing else
+            members = dict(members)
+            orig_reader = iter_chunks(ORIG_DATA_PATH, columns=('image',),
+                                      start=breakpoint, stop=max(members) + 1,
+                                      chunksize=CHUNK_SIZE)
+            for chunk in orig_reader:
+                process_chunk(members, chunk)
+                print('Loading next chunk...')
 
     print('All done!')
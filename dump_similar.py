@@ -6,13 +6,18 @@ __author__ = 'Xiaoguang Zhu'
 
 from face_recognition import compare_faces
 
-import sqlite3
-import pickle
-import base64
-
-import pandas as pd
+import numpy as np
 
 import os
+import argparse
+
+from tsv_index import TsvIndex
+from tsv_reader import COLUMNS, iter_chunks
+from encoding_store import (FORMAT_PACKED, ENCODING_DIM, ENCODING_DTYPE,
+                            get_encoding_format, unpack_encodings,
+                            fetch_range)
+from storage import SELECT_ENCODING, connect
+from image_writer import open_image_writer
 
 
 ''' Configuration Variables '''
@@ -21,12 +26,27 @@ BASE_CLASS          = 0
 
 BREAKPOINT_PATH     = './bkpt_{}_similar'.format(BASE_CLASS)
 OUTPUT_DIR          = './output-{}-similar'.format(BASE_CLASS)
+OUTPUT_MODE         = 'folders'     # or `'packed'`, see `image_writer.py`
 
 ORIGINAL_DATA_PATH  = '../FaceImageCroppedWithoutAlignment.tsv'
 CHUNK_SIZE          = int(1e3)
 
 DATABASE_PATH       = './encodings.db'
 
+# multi-query mode, see `multi_query_main()`
+TOLERANCE           = 0.54
+TOP_K               = 100
+MULTI_OUTPUT_DIR    = './output-similar'
+# memory-mapped matrix of all single-face encodings
+MATRIX_CACHE_DIR    = './similar_cache'
+# encodings compared per matrix multiply
+BLOCK_SIZE          = int(1e5)
+
+# blob format of database, see `encoding_store.py`
+encoding_format     = FORMAT_PACKED
+# background image writer, created in `main()`
+image_writer        = None
+
 
 ''' Session Control '''
 
@@ -61,75 +81,69 @@ def save_breakpoint(path=BREAKPOINT_PATH):
 ''' Helper Functions - Database '''
 
 def retrieve_encodings_by_id(db_cursor, idx):
-    db_cursor.execute(
-        '''
-        SELECT encoding FROM encodings
-        WHERE
-            id = ?
-        ''',
-        (idx,)
-    )
+    db_cursor.execute(SELECT_ENCODING, (idx,))
     encodings = db_cursor.fetchone()
     if encodings is None:
         return None
     encodings = encodings[0]
-    encodings = pickle.loads(encodings)
+    encodings = unpack_encodings(encodings, encoding_format)
     return encodings
 
 
 ''' Helper Functions - File I/O '''
 
-def save_record_to_folder(
-        rec,
-        format='jpg',
-        path=OUTPUT_DIR):
+def save_record_to_folder(rec, format='jpg'):
     '''
-    save record to corresponding classified folder
+    save record to `OUTPUT_DIR`
 
     Args:
-        `rec`: `pandas`-read record
+        `rec`: original data record, see `tsv_reader.py`
         `format`: format of input image (will be used as output format too)
-        `path`: output directory
     '''
-    target_path = os.path.join(path, '{}.{}'.format(rec.name, format))
-    with open(target_path, 'wb') as f:
-        f.write(base64.b64decode(rec[6]))
+    image_writer.write_record(None, None, rec.idx, rec.image, format=format)
 
 
 ''' Process '''
 
-def process_record(db_cursor, target_encoding, rec):
+def process_record(chunk_encodings, target_encoding, rec):
     global breakpoint
-    print('Processing {}...'.format(rec.name))
-    other_encoding = retrieve_encodings_by_id(db_cursor, rec.name)
+    print('Processing {}...'.format(rec.idx))
+    other_encoding = chunk_encodings.get(rec.idx)
+    if other_encoding is not None:
+        other_encoding = unpack_encodings(other_encoding, encoding_format)
     if other_encoding is None or len(other_encoding) != 1:
         pass
     else:
         if compare_faces(target_encoding, other_encoding[0],
                          tolerance=0.54)[0]:
             save_record_to_folder(rec)
-    breakpoint = rec.name
+    breakpoint = rec.idx
 
 
 def process_chunk(db_connection, target_encoding, chunk):
     print('Starting with chunk {} - {}...'
-          .format(chunk.iloc[0].name, chunk.iloc[1].name))
-    if breakpoint > chunk.iloc[-1].name:
+          .format(chunk[0].idx, chunk[-1].idx))
+    if breakpoint > chunk[-1].idx:
         print('Skipping this chunk for it\'s already been processed...')
         return
     db_cursor = db_connection.cursor()
-    for idx, rec in chunk.iterrows():
-        process_record(db_cursor, target_encoding, rec)
+    chunk_encodings = fetch_range(db_cursor,
+                                  chunk[0].idx, chunk[-1].idx)
+    for rec in chunk:
+        process_record(chunk_encodings, target_encoding, rec)
+    image_writer.flush()
     save_breakpoint()
 
 
 def main():
+    global encoding_format, image_writer
     load_breakpoint()
-    orig_reader = pd.read_csv(ORIGINAL_DATA_PATH,
-                              sep='\t', header=None,
-                              chunksize=CHUNK_SIZE)
-    with sqlite3.connect(DATABASE_PATH) as db_connection:
+    orig_reader = iter_chunks(ORIGINAL_DATA_PATH, columns=('image',),
+                              start=breakpoint, chunksize=CHUNK_SIZE)
+    with connect(DATABASE_PATH) as db_connection, \
+            open_image_writer(OUTPUT_DIR, OUTPUT_MODE) as image_writer:
         db_cursor = db_connection.cursor()
+        encoding_format = get_encoding_format(db_cursor)
         target_encoding = retrieve_encodings_by_id(db_cursor, BASE_CLASS)
         if target_encoding is None or len(target_encoding) != 1:
             raise ValueError('Bad choice on base class!')
@@ -139,8 +153,221 @@ def main():
     print('All done!')
 
 
+''' Multi-Query Search '''
+
+def get_cache_stamp(db_cursor):
+    '''
+    stamp of `encodings` the encoding matrix is built from
+
+    Return:
+        `int64` array of `MAX(id)`, row count and blob format
+    '''
+    db_cursor.execute('SELECT MAX(id), COUNT(*) FROM encodings')
+    max_id, rows = db_cursor.fetchone()
+    return np.array([-1 if max_id is None else max_id, rows,
+                     encoding_format], dtype=np.int64)
+
+
+def is_cache_fresh(db_cursor, cache_dir=MATRIX_CACHE_DIR):
+    '''
+    whether the encoding matrix under `cache_dir` was completely built from
+    `encodings` as they are now
+    '''
+    path = os.path.join(cache_dir, 'stamp.npy')
+    return os.path.exists(path) and \
+        np.array_equal(np.load(path), get_cache_stamp(db_cursor))
+
+
+def build_encoding_matrix(db_connection, cache_dir=MATRIX_CACHE_DIR):
+    '''
+    dump all single-face encodings into a memory-mappable matrix
+
+    Writes `ids.npy` (`int64[n]`) and `encodings.f32` (`float32[n, 128]`)
+    under `cache_dir`, and finally `stamp.npy`, see `get_cache_stamp()`.
+
+    Return:
+        number of encodings dumped
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    ids = []
+    c = db_connection.cursor()
+    # taken before, so that rows added meanwhile make the cache stale
+    stamp = get_cache_stamp(c)
+    stamp_path = os.path.join(cache_dir, 'stamp.npy')
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+    c.execute('SELECT id, encoding FROM encodings ORDER BY id')
+    with open(os.path.join(cache_dir, 'encodings.f32'), 'wb') as f:
+        while True:
+            rows = c.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            for idx, blob in rows:
+                encodings = unpack_encodings(blob, encoding_format)
+                if len(encodings) != 1:
+                    continue
+                ids.append(idx)
+                f.write(np.asarray(encodings, dtype=ENCODING_DTYPE)
+                        .tobytes())
+            print('Dumped encodings up to {}...'.format(rows[-1][0]))
+    np.save(os.path.join(cache_dir, 'ids.npy'),
+            np.array(ids, dtype=np.int64))
+    np.save(stamp_path, stamp)
+    return len(ids)
+
+
+def load_encoding_matrix(cache_dir=MATRIX_CACHE_DIR):
+    '''
+    Return:
+        `(ids, matrix)`, `matrix` being a read-only `np.memmap`
+    '''
+    ids = np.load(os.path.join(cache_dir, 'ids.npy'))
+    matrix = np.memmap(os.path.join(cache_dir, 'encodings.f32'),
+                       dtype=ENCODING_DTYPE, mode='r',
+                       shape=(len(ids), ENCODING_DIM))
+    return ids, matrix
+
+
+def search(ids, matrix, queries, tolerance=TOLERANCE, top_k=TOP_K,
+           block_size=BLOCK_SIZE):
+    '''
+    find encodings similar to each query, in blocked matrix multiplies
+
+    Squared distances of a block are computed for all queries at once as
+    `|x|^2 - 2 x.q + |q|^2`.
+
+    Args:
+        `ids`: record ids of `matrix` rows
+        `matrix`: encodings of shape `[n, 128]`
+        `queries`: query encodings of shape `[q, 128]`
+        `tolerance`: max distance for a hit
+        `top_k`: length of nearest neighbour list of each query
+
+    Return:
+        `(hits, tops)`, both lists of `[ (id, distance) ]` per query, `hits`
+        in id order and `tops` in distance order
+    '''
+    queries = np.asarray(queries, dtype=np.float32)
+    q_norms = np.einsum('ij,ij->i', queries, queries)
+    hits = [[] for _ in queries]
+    # running top-k of each query, as (squared distances, ids)
+    top_dists = np.full((len(queries), 0), np.inf, dtype=np.float32)
+    top_ids = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(ids), block_size):
+        block = np.asarray(matrix[start:start + block_size])
+        block_ids = ids[start:start + block_size]
+        dists = (np.einsum('ij,ij->i', block, block)[None, :]
+                 - 2 * queries @ block.T + q_norms[:, None])
+        np.maximum(dists, 0, out=dists)
+        for q, cols in zip(*np.nonzero(dists <= tolerance ** 2)):
+            hits[q].append((int(block_ids[cols]),
+                            float(np.sqrt(dists[q, cols]))))
+        # merge block into running top-k
+        top_dists = np.concatenate([top_dists, dists], axis=1)
+        top_ids = np.concatenate(
+            [top_ids, np.broadcast_to(block_ids, dists.shape)], axis=1)
+        if top_dists.shape[1] > top_k:
+            keep = np.argpartition(top_dists, top_k - 1, axis=1)[:, :top_k]
+            top_dists = np.take_along_axis(top_dists, keep, axis=1)
+            top_ids = np.take_along_axis(top_ids, keep, axis=1)
+        print('Searched {} / {} encodings...'
+              .format(min(start + block_size, len(ids)), len(ids)))
+    order = np.argsort(top_dists, axis=1)
+    top_dists = np.sqrt(np.take_along_axis(top_dists, order, axis=1))
+    top_ids = np.take_along_axis(top_ids, order, axis=1)
+    tops = [list(zip(row_ids.tolist(), row_dists.tolist()))
+            for row_ids, row_dists in zip(top_ids, top_dists)]
+    return hits, tops
+
+
+def save_results(query_ids, hits, tops, output_dir=MULTI_OUTPUT_DIR):
+    '''
+    write `<query>.hits.tsv` and `<query>.top.tsv` of `id\tdistance` lines
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for query_id, query_hits, query_tops in zip(query_ids, hits, tops):
+        for suffix, results in (('hits', query_hits), ('top', query_tops)):
+            path = os.path.join(output_dir,
+                                '{}.{}.tsv'.format(query_id, suffix))
+            with open(path, 'w') as f:
+                for idx, dist in results:
+                    f.write('{}\t{:.4f}\n'.format(idx, dist))
+
+
+def dump_hits(query_ids, hits):
+    '''
+    dump images of hits into one folder per query, reading only those
+    records, with seeks if an index is available
+    '''
+    targets = {}
+    for query_id, query_hits in zip(query_ids, hits):
+        for idx, _ in query_hits:
+            targets.setdefault(idx, []).append(query_id)
+    index = TsvIndex.load(ORIGINAL_DATA_PATH)
+    if index is not None:
+        for idx in sorted(targets):
+            payload = index.read_record(idx)[COLUMNS['image']]
+            for query_id in targets[idx]:
+                image_writer.write_record(None, query_id, idx, payload)
+        index.close()
+        return
+    # no index, fall back to streaming only until the last target
+    stop = max(targets) + 1 if targets else 0
+    for chunk in iter_chunks(ORIGINAL_DATA_PATH, columns=('image',),
+                             stop=stop, chunksize=CHUNK_SIZE):
+        for rec in chunk:
+            for query_id in targets.get(rec.idx, ()):
+                image_writer.write_record(None, query_id, rec.idx, rec.image)
+
+
+def multi_query_main(query_ids, top_k=TOP_K, rebuild=False):
+    '''
+    find faces similar to each of `query_ids` in a single pass over a
+    memory-mapped encoding matrix, instead of one full `.tsv` pass per query
+    '''
+    global encoding_format, image_writer
+    with connect(DATABASE_PATH) as db_connection:
+        db_cursor = db_connection.cursor()
+        encoding_format = get_encoding_format(db_cursor)
+        queries = []
+        for query_id in query_ids:
+            encodings = retrieve_encodings_by_id(db_cursor, query_id)
+            if encodings is None or len(encodings) != 1:
+                raise ValueError('Bad choice on query {}!'.format(query_id))
+            queries.append(encodings[0])
+        if rebuild or not is_cache_fresh(db_cursor):
+            print('Building encoding matrix...')
+            build_encoding_matrix(db_connection)
+    ids, matrix = load_encoding_matrix()
+    hits, tops = search(ids, matrix, queries, top_k=top_k)
+    save_results(query_ids, hits, tops)
+    for query_id, query_hits in zip(query_ids, hits):
+        print('Query {}: {} hits.'.format(query_id, len(query_hits)))
+    with open_image_writer(MULTI_OUTPUT_DIR, OUTPUT_MODE) as image_writer:
+        dump_hits(query_ids, hits)
+    print('All done!')
+
+
 ''' Main '''
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(
+        description='''Dump faces similar to `BASE_CLASS`, or to each of
+`--query-ids` in a single batched search.''')
+    parser.add_argument('-q', '--query-ids', nargs='+', type=int,
+                        help='''Record ids of query faces.''')
+    parser.add_argument('-k', '--top-k', type=int, default=TOP_K,
+                        help='''Length of nearest neighbour list per
+query.''')
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help='''Rebuild the encoding matrix cache, even if
+`encodings.db` did not gain or lose rows since.''')
+    args = parser.parse_args()
+    if args.query_ids:
+        multi_query_main(args.query_ids, top_k=args.top_k,
+                         rebuild=args.rebuild_cache)
+    else:
+        main()
 
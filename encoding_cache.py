@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Content-addressed cache of face encodings.
+
+The original data holds many repeated crops under different entries, and
+`face_recognition.face_encodings()` is by far the most expensive step of
+`extract_to_db.py`. Encodings are therefore cached by the BLAKE2b digest of
+the base64 payload, in a table next to `encodings`::
+
+    encoding_cache (
+        digest      blob    primary key ,   -- `get_digest()` of payload
+        encoding    blob    not null    ,   -- always `FORMAT_PACKED`
+        count       integer not null    ,   -- faces detected
+        box_*       integer                 -- box of largest face
+    )
+
+and looked up before an image is even decoded. Extraction options other than
+the defaults (e.g. `--faces largest`) give different results for the same
+payload, so they are hashed in as `salt`. The cache is merged along with
+shards by `merge_shards.py`, and could be carried over to the database of a
+new data drop with::
+
+    python encoding_cache.py import <from.db> [<to.db>]
+    python encoding_cache.py stats [<db>]
+'''
+
+import sys
+import hashlib
+
+from collections import OrderedDict
+
+from encoding_store import (FORMAT_PACKED, BOX_COLUMNS, pack_encodings,
+                            unpack_encodings)
+from storage import SQL_VARIABLES_LIMIT, connect
+
+
+''' Configurations '''
+
+DB_PATH = './encodings.db'
+DIGEST_SIZE = 16
+# entries put in deferred mode still served from memory, they may not be
+# committed by the other connection yet
+RECENT_ENTRIES = int(2e4)
+
+
+''' Statements '''
+
+INSERT_CACHE_ENTRY = '''
+    INSERT OR IGNORE INTO encoding_cache
+        (digest, encoding, count, box_top, box_right, box_bottom, box_left)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+''' Helper Functions '''
+
+def get_digest(payload, salt=b''):
+    '''
+    content hash of an image payload
+
+    Args:
+        `payload`: base64 `str` or raw image `bytes`
+        `salt`: `bytes` identifying extraction options, empty for defaults
+
+    Return:
+        `bytes` of length `DIGEST_SIZE`
+    '''
+    if isinstance(payload, str):
+        payload = payload.encode('ascii')
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    h.update(salt)
+    h.update(payload)
+    return h.digest()
+
+
+def get_cache_row(digest, encodings, count=None, box=None):
+    '''
+    parameters of `INSERT_CACHE_ENTRY`, see `EncodingCache.put()`
+    '''
+    if count is None:
+        count = len(encodings)
+    return (digest, pack_encodings(encodings, FORMAT_PACKED), count) \
+        + (tuple(box) if box is not None else (None,) * 4)
+
+
+def get_cache_columns(db_connection, schema='main'):
+    return [row[1] for row in db_connection.execute(
+        'PRAGMA {}.table_info(encoding_cache)'.format(schema))]
+
+
+def create_cache_table(db_connection):
+    db_connection.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS encoding_cache (
+            digest      blob        primary key     ,
+            encoding    blob        not null        ,
+            count       integer     not null        ,
+            box_top     integer                     ,
+            box_right   integer                     ,
+            box_bottom  integer                     ,
+            box_left    integer
+        )'''
+    )
+    columns = get_cache_columns(db_connection)
+    for column in BOX_COLUMNS:
+        if column not in columns:
+            db_connection.execute(
+                'ALTER TABLE encoding_cache ADD COLUMN {} integer'
+                .format(column))
+
+
+def copy_cache(db_connection, path):
+    '''
+    copy all cache entries of database `path` into `db_connection`, entries
+    already present are kept untouched, not committed
+
+    Return:
+        number of entries copied
+    '''
+    create_cache_table(db_connection)
+    c = db_connection.cursor()
+    c.execute('ATTACH DATABASE ? AS other', (path,))
+    try:
+        c.execute('''
+            SELECT name FROM other.sqlite_master
+            WHERE
+                type = 'table' AND name = 'encoding_cache'
+        ''')
+        if c.fetchone() is None:
+            return 0
+        # only copy columns both sides know about
+        other_columns = set(get_cache_columns(db_connection, 'other'))
+        columns = ', '.join(col for col in get_cache_columns(db_connection)
+                            if col in other_columns)
+        c.execute('''
+            INSERT OR IGNORE INTO main.encoding_cache ({0})
+            SELECT {0} FROM other.encoding_cache
+        '''.format(columns))
+        copied = c.rowcount
+        db_connection.commit()
+    finally:
+        c.execute('DETACH DATABASE other')
+    return copied
+
+
+''' Cache '''
+
+class EncodingCache(object):
+    '''
+    digest -> `(encodings, count, box)` cache backed by table
+    `encoding_cache`
+
+    Entries are written with the caller's transaction, so they are committed
+    along with the encodings they came from. With `deferred`, they are kept
+    in `pending_rows` instead, for another connection (e.g. the writer stage
+    of `stages.py`) to insert with `INSERT_CACHE_ENTRY`, see `take_rows()`,
+    and the last `RECENT_ENTRIES` are looked up in memory until then.
+    '''
+
+    def __init__(self, db_connection, deferred=False):
+        self.db_connection = db_connection
+        create_cache_table(db_connection)
+        db_connection.commit()
+        self.deferred = deferred
+        self.pending_rows = []
+        self._recent = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        '''
+        Return:
+            `(encodings, count, box)`, or `None` if not cached
+        '''
+        found = self.lookup([digest])
+        return found.get(digest)
+
+    def lookup(self, digests):
+        '''
+        look up many digests in a few queries
+
+        Return:
+            `{ digest: (encodings, count, box) }` of digests found, `box`
+            being `None` if no face
+        '''
+        found = {digest: self._recent[digest] for digest in set(digests)
+                 if digest in self._recent}
+        digests = [digest for digest in set(digests) if digest not in found]
+        c = self.db_connection.cursor()
+        for start in range(0, len(digests), SQL_VARIABLES_LIMIT):
+            batch = digests[start:start + SQL_VARIABLES_LIMIT]
+            c.execute(
+                '''
+                SELECT digest, encoding, count, {} FROM encoding_cache
+                WHERE
+                    digest IN ({})
+                '''.format(', '.join(BOX_COLUMNS),
+                           ', '.join('?' * len(batch))),
+                batch
+            )
+            for digest, blob, count, *box in c.fetchall():
+                found[bytes(digest)] = (
+                    unpack_encodings(blob, FORMAT_PACKED), count,
+                    None if box[0] is None else tuple(box))
+        return found
+
+    def put(self, digest, encodings, count=None, box=None):
+        '''
+        cache results of a payload, not committed
+
+        Args:
+            `digest`: `get_digest()` of payload
+            `encodings`: encodings of faces used
+            `count`: faces detected, `len(encodings)` if `None`
+            `box`: `(top, right, bottom, left)` of largest face, or `None`
+        '''
+        row = get_cache_row(digest, encodings, count, box)
+        if self.deferred:
+            self.pending_rows.append(row)
+            self._recent[digest] = (encodings, row[2], box)
+            if len(self._recent) > RECENT_ENTRIES:
+                self._recent.popitem(last=False)
+        else:
+            self.db_connection.execute(INSERT_CACHE_ENTRY, row)
+
+    def take_rows(self):
+        '''
+        Return:
+            rows put since last call, in deferred mode
+        '''
+        rows, self.pending_rows = self.pending_rows, []
+        return rows
+
+    def record(self, hits, misses):
+        '''
+        count records served from cache (or not)
+        '''
+        self.hits += hits
+        self.misses += misses
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def report(self):
+        return 'Encoding cache: {} hits, {} misses, hit rate {:.2%}.'.format(
+            self.hits, self.misses, self.hit_rate)
+
+
+def encode_cached(encoding_cache, encode, pending, salt=b''):
+    '''
+    encode payloads, skipping those cached or repeated in `pending`
+
+    Args:
+        `encoding_cache`: `EncodingCache`, or `None` to encode everything
+        `encode`: `encode()` of an `EncodingServer` or `LocalEncoder`
+        `pending`: `[ (idx, payload) ]`
+        `salt`: see `get_digest()`
+
+    Return:
+        iterator over `(idx, (encodings, count, box))`, in input order
+    '''
+    if encoding_cache is None:
+        return encode(pending)
+    digests = [get_digest(payload, salt) for _, payload in pending]
+    known = encoding_cache.lookup(digests)
+    jobs = {}
+    for digest, (_, payload) in zip(digests, pending):
+        if digest not in known:
+            jobs.setdefault(digest, payload)
+    for digest, faces in encode(jobs.items()):
+        encoding_cache.put(digest, *faces)
+        known[digest] = faces
+    encoding_cache.record(len(pending) - len(jobs), len(jobs))
+    return ((idx, known[digest])
+            for (idx, _), digest in zip(pending, digests))
+
+
+''' Main '''
+
+if __name__ == '__main__':
+    if len(sys.argv) in (3, 4) and sys.argv[1] == 'import':
+        with connect(sys.argv[3] if len(sys.argv) == 4 else DB_PATH) as conn:
+            print('{} entries imported.'.format(copy_cache(conn,
+                                                           sys.argv[2])))
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == 'stats':
+        with connect(sys.argv[2] if len(sys.argv) == 3 else DB_PATH) as conn:
+            create_cache_table(conn)
+            entries, faces = conn.execute(
+                'SELECT COUNT(*), TOTAL(count) FROM encoding_cache'
+            ).fetchone()
+            print('{} entries, {:.0f} faces.'.format(entries, faces))
+    else:
+        print(__doc__)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Long-lived face encoding workers.
+
+Loading the `dlib` models behind `face_recognition` costs far more than
+encoding a single cropped face, so forking a fresh worker per task is slower
+than running single-threaded. Instead, workers here are started **once** per
+session, each loads the models in its initializer, and afterwards only image
+payloads (base64 text or raw JPEG bytes) travel through the pool pipes.
+
+How faces are detected and which of them are encoded is controlled by
+`ExtractOptions`, see `extract_faces()`.
+'''
+
+from collections import namedtuple
+
+import multiprocessing as mp
+
+from image_decode import MAX_SIZE, decode_image_scaled
+
+
+''' Configurations '''
+
+PROCESSES_COUNT = max(mp.cpu_count() - 1, 1)
+# records sent to a worker per pipe round trip
+DISPATCH_CHUNK_SIZE = 8
+
+# `'all'` encodes every face detected, `'largest'` only the largest one
+FACE_MODES = ('all', 'largest')
+# `face_recognition.face_locations()` detectors
+DETECTOR_MODELS = ('hog', 'cnn')
+
+
+''' Extraction '''
+
+ExtractOptions = namedtuple('ExtractOptions', (
+    'mode',         # one of `FACE_MODES`
+    'max_faces',    # encode nothing if more faces detected, `None` for any
+    'upsample',     # times to upsample image when detecting
+    'model',        # one of `DETECTOR_MODELS`
+    'max_size',     # longest side to decode at, see `image_decode.py`
+))
+DEFAULT_OPTIONS = ExtractOptions('all', None, 1, 'hog', MAX_SIZE)
+
+# result of `extract_faces()`, `count` being the number of faces detected,
+# and `box` the `(top, right, bottom, left)` of the largest face in original
+# resolution, `None` if no face
+Faces = namedtuple('Faces', ('encodings', 'count', 'box'))
+
+
+def get_options_salt(options):
+    '''
+    cache salt of extraction options, see `encoding_cache.get_digest()`
+
+    Empty only for the default options at full resolution, which entries
+    cached before options existed were computed with. Any `max_size`, even
+    the default one, is salted in.
+    '''
+    if options == DEFAULT_OPTIONS._replace(max_size=None):
+        return b''
+    return repr(tuple(options)).encode('ascii')
+
+
+def get_box_area(box):
+    top, right, bottom, left = box
+    return (bottom - top) * (right - left)
+
+
+def clip_box(box, shape):
+    '''
+    clip `(top, right, bottom, left)` to an image of `shape`
+    '''
+    top, right, bottom, left = box
+    return max(top, 0), min(right, shape[1]), min(bottom, shape[0]), \
+        max(left, 0)
+
+
+def detect_faces(fr, imgarr, upsample=1, model='hog'):
+    '''
+    boxes of faces as found by the detector
+
+    Unlike `fr.face_locations()`, boxes are not clipped to the image, just as
+    `fr.face_encodings(imgarr)` aligns faces when not given locations. On
+    this pre-cropped dataset, boxes often reach past the image edges, and
+    clipping them would change the encodings.
+
+    :return: `[ (top, right, bottom, left) ]`
+    '''
+    detections = fr.api._raw_face_locations(imgarr, upsample, model)
+    if model == 'cnn':
+        detections = [detection.rect for detection in detections]
+    return [(rect.top(), rect.right(), rect.bottom(), rect.left())
+            for rect in detections]
+
+
+def extract_faces(fr, imgarr, scale=1., options=DEFAULT_OPTIONS):
+    '''
+    detect faces in an image, and encode those to be used
+
+    With the default options this is exactly `fr.face_encodings(imgarr)`.
+    Faces are encoded with the unclipped boxes of `detect_faces()`, only
+    the `box` recorded is clipped to the image.
+
+    :param fr: the `face_recognition` module
+    :param imgarr: decoded image
+    :param scale: original over decoded resolution, see `image_decode.py`
+    :param options: `ExtractOptions`
+    :return: `Faces`
+    '''
+    locations = detect_faces(fr, imgarr, options.upsample, options.model)
+    if not locations:
+        return Faces([], 0, None)
+    clipped = [clip_box(location, imgarr.shape) for location in locations]
+    row = max(range(len(clipped)), key=lambda i: get_box_area(clipped[i]))
+    box = tuple(int(round(x * scale)) for x in clipped[row])
+    if options.max_faces is not None and len(locations) > options.max_faces:
+        return Faces([], len(locations), box)
+    if options.mode == 'largest':
+        encodings = fr.face_encodings(imgarr,
+                                      known_face_locations=[locations[row]])
+    else:
+        encodings = fr.face_encodings(imgarr, known_face_locations=locations)
+    return Faces(encodings, len(locations), box)
+
+
+def encode_payload(fr, payload, options=DEFAULT_OPTIONS):
+    '''
+    decode an image payload and `extract_faces()` from it
+    '''
+    imgarr, scale = decode_image_scaled(payload, options.max_size)
+    return extract_faces(fr, imgarr, scale, options)
+
+
+''' Worker Side '''
+
+_fr = None
+_options = DEFAULT_OPTIONS
+
+
+def _init_worker(options=DEFAULT_OPTIONS):
+    '''
+    worker initializer, loads `face_recognition` models exactly once
+    '''
+    global _fr, _options
+    import face_recognition
+    _fr = face_recognition
+    _options = options
+
+
+def _encode_job(job):
+    idx, payload = job
+    return idx, encode_payload(_fr, payload, _options)
+
+
+''' Server '''
+
+class EncodingServer(object):
+    '''
+    a pool of persistent encoding workers
+
+    Usage::
+
+        with EncodingServer(processes=7) as server:
+            for idx, faces in server.encode(jobs):
+                ...
+
+    where `jobs` is an iterable of `(idx, payload)` tuples. Results are
+    yielded in the same order as `jobs`.
+    '''
+
+    def __init__(self, processes=PROCESSES_COUNT,
+                 chunksize=DISPATCH_CHUNK_SIZE, options=DEFAULT_OPTIONS):
+        self.processes = processes
+        self.chunksize = chunksize
+        self.options = options
+        self._pool = None
+
+    def start(self):
+        if self._pool is None:
+            print('Starting {} encoding workers...'.format(self.processes))
+            self._pool = mp.Pool(processes=self.processes,
+                                 initializer=_init_worker,
+                                 initargs=(self.options,))
+        return self
+
+    def encode(self, jobs):
+        '''
+        encode a batch of images on the worker pool
+
+        :param jobs: iterable of `(idx, payload)`
+        :return: iterator over `(idx, Faces)`, in input order
+        '''
+        if self._pool is None:
+            raise RuntimeError('Encoding server not started!')
+        return self._pool.imap(_encode_job, jobs, chunksize=self.chunksize)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+class LocalEncoder(object):
+    '''
+    same interface as `EncodingServer`, encoding in the calling process
+    '''
+
+    def __init__(self, options=DEFAULT_OPTIONS):
+        self.options = options
+        self._fr = None
+
+    def start(self):
+        if self._fr is None:
+            import face_recognition
+            self._fr = face_recognition
+        return self
+
+    def encode(self, jobs):
+        for idx, payload in jobs:
+            yield idx, encode_payload(self._fr, payload, self.options)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_encoder(processes=PROCESSES_COUNT, options=DEFAULT_OPTIONS):
+    '''
+    `EncodingServer` of `processes` workers, or `LocalEncoder` if `1`
+    '''
+    if processes > 1:
+        return EncodingServer(processes=processes, options=options)
+    return LocalEncoder(options=options)
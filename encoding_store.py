@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Storage format of the `encoding` blob in `encodings.db`.
+
+Two formats exist, told apart by `PRAGMA user_version` of the database:
+
+    - `FORMAT_PICKLE` (`0`): legacy, `pickle.dumps()` of the list of
+      `np.ndarray`s returned by `face_recognition.face_encodings()`
+    - `FORMAT_PACKED` (`1`): the encodings as contiguous little-endian
+      `float32[count, 128]` bytes, with `count` stored in its own column, so
+      they are read back zero-copy with `np.frombuffer`
+
+Fresh databases are created packed, legacy ones keep being written in pickle
+until converted with `migrate_encodings.py`.
+
+Column `count` holds the number of faces **detected**, which may be more than
+the encodings in the blob when only the largest face is encoded (see
+`extract_faces()` in `encoding_server.py`), and `box_*` the bounding box of
+the largest face.
+'''
+
+import numpy as np
+
+import pickle
+import sqlite3
+
+from storage import SQL_VARIABLES_LIMIT, SELECT_RANGE, SELECT_IN
+
+
+''' Configurations '''
+
+ENCODING_DIM = 128
+ENCODING_DTYPE = np.dtype('<f4')
+ENCODING_BYTES = ENCODING_DIM * ENCODING_DTYPE.itemsize
+
+FORMAT_PICKLE = 0
+FORMAT_PACKED = 1
+
+# bounding box of the largest face, in `face_recognition` order
+BOX_COLUMNS = ('box_top', 'box_right', 'box_bottom', 'box_left')
+# columns of table `encodings`, in order
+ENCODING_COLUMNS = ('id', 'encoding', 'belong', 'orig_class', 'count') + \
+    BOX_COLUMNS
+
+
+''' Schema '''
+
+def get_encoding_format(db_cursor):
+    '''
+    get blob format of the database `db_cursor` belongs to
+
+    Return:
+        `FORMAT_PICKLE` or `FORMAT_PACKED`
+    '''
+    db_cursor.execute('PRAGMA user_version')
+    return db_cursor.fetchone()[0]
+
+
+def set_encoding_format(db_cursor, format):
+    # NOTE: `PRAGMA` does not take `?` parameters
+    db_cursor.execute('PRAGMA user_version = {:d}'.format(format))
+
+
+def create_encodings_table(db_cursor, table='encodings'):
+    '''
+    create a table of `ENCODING_COLUMNS` named `table`, if not exists
+    '''
+    db_cursor.execute('''
+        CREATE TABLE IF NOT EXISTS {} (
+            id          integer     primary key     ,
+            encoding    blob        not null        ,
+            belong      integer                     ,
+            orig_class  text                        ,
+            count       integer                     ,
+            box_top     integer                     ,
+            box_right   integer                     ,
+            box_bottom  integer                     ,
+            box_left    integer
+        )'''.format(table)
+    )
+
+
+def ensure_schema(db_connection):
+    '''
+    create table `encodings` if not exists, adding columns `orig_class`,
+    `count` and `box_*` to legacy tables that lack them
+
+    A newly created table is marked as `FORMAT_PACKED`.
+
+    Args:
+        `db_connection`: top-level (or shard) database connection
+
+    Return:
+        blob format of the database
+    '''
+    c = db_connection.cursor()
+    c.execute('PRAGMA table_info(encodings)')
+    columns = [row[1] for row in c.fetchall()]
+    if not columns:
+        create_encodings_table(c)
+        set_encoding_format(c, FORMAT_PACKED)
+    else:
+        if 'orig_class' not in columns:
+            c.execute('ALTER TABLE encodings ADD COLUMN orig_class text')
+        if 'count' not in columns:
+            c.execute('ALTER TABLE encodings ADD COLUMN count integer')
+        for column in BOX_COLUMNS:
+            if column not in columns:
+                c.execute('ALTER TABLE encodings ADD COLUMN {} integer'
+                          .format(column))
+    db_connection.commit()
+    return get_encoding_format(c)
+
+
+''' Blob Encoding / Decoding '''
+
+def pack_encodings(encodings, format=FORMAT_PACKED):
+    '''
+    serialize list of encodings for the `encoding` column
+
+    Args:
+        `encodings`: `[ np.ndarray ]` as returned by `fr.face_encodings()`
+        `format`: target blob format
+
+    Return:
+        `sqlite3.Binary`
+    '''
+    if format == FORMAT_PICKLE:
+        return sqlite3.Binary(pickle.dumps(list(encodings)))
+    if len(encodings) == 0:
+        return sqlite3.Binary(b'')
+    arr = np.asarray(encodings, dtype=ENCODING_DTYPE)
+    return sqlite3.Binary(arr.reshape(-1, ENCODING_DIM).tobytes())
+
+
+def unpack_encodings(blob, format=FORMAT_PACKED):
+    '''
+    deserialize the `encoding` column
+
+    Args:
+        `blob`: `bytes` read from the `encoding` column
+        `format`: blob format of the database
+
+    Return:
+        `np.ndarray` of shape `[count, 128]`, read-only when `FORMAT_PACKED`
+    '''
+    if format == FORMAT_PICKLE:
+        encodings = pickle.loads(blob)
+        if not encodings:
+            return np.empty((0, ENCODING_DIM), dtype=ENCODING_DTYPE)
+        return np.asarray(encodings)
+    return np.frombuffer(blob, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_DIM)
+
+
+def count_encodings(blob, format=FORMAT_PACKED):
+    '''
+    number of encodings (i.e. detected faces) in a blob, without decoding it
+    if possible
+    '''
+    if format == FORMAT_PICKLE:
+        return len(pickle.loads(blob))
+    return len(blob) // ENCODING_BYTES
+
+
+def get_encoding_row(idx, encodings, count, box, format=FORMAT_PACKED):
+    '''
+    parameters of `storage.INSERT_ENCODING`
+
+    Args:
+        `idx`: record id
+        `encodings`: encodings of faces used
+        `count`: faces detected
+        `box`: `(top, right, bottom, left)` of largest face, or `None`
+        `format`: blob format of the database
+    '''
+    if box is None:
+        box = (None,) * len(BOX_COLUMNS)
+    return (idx, pack_encodings(encodings, format), count) + tuple(box)
+
+
+''' Bulk Access '''
+
+def fetch_range(db_cursor, first, last, column='encoding'):
+    '''
+    fetch one column of all records with `first <= id <= last` in a single
+    range query, instead of one `SELECT` per record
+
+    Args:
+        `db_cursor`: database cursor
+        `first`: first record id
+        `last`: last record id (inclusive)
+        `column`: column to fetch
+
+    Return:
+        `{ id: value }`, records not in database are absent
+    '''
+    db_cursor.execute(SELECT_RANGE.format(column), (int(first), int(last)))
+    return dict(db_cursor.fetchall())
+
+
+def fetch_ids(db_cursor, ids, column='encoding'):
+    '''
+    fetch one column of records by id, `SQL_VARIABLES_LIMIT` ids per query,
+    for ids too scattered to fetch as a range
+
+    Args:
+        `db_cursor`: database cursor
+        `ids`: record ids
+        `column`: column to fetch
+
+    Return:
+        `{ id: value }`, records not in database are absent
+    '''
+    ids = [int(idx) for idx in ids]
+    values = {}
+    for start in range(0, len(ids), SQL_VARIABLES_LIMIT):
+        batch = ids[start:start + SQL_VARIABLES_LIMIT]
+        db_cursor.execute(
+            SELECT_IN.format(column, ', '.join('?' * len(batch))), batch)
+        values.update(db_cursor.fetchall())
+    return values
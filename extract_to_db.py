@@ -7,28 +7,44 @@ is to dump base64-encoded images in original data to a folder filled with
 
 __author__ = 'Xiaoguang Zhu'
 
-import io
-import base64
-
-import matplotlib.image as mpimage
-
-import numpy as np
-import pandas as pd
-from PIL import Image
-
 import os
-import pickle
-import sqlite3
+import sys
+import subprocess
 
 import argparse
 
 import face_recognition as fr
 
+from encoding_server import (FACE_MODES, DETECTOR_MODELS, DEFAULT_OPTIONS,
+                             EncodingServer, get_options_salt, open_encoder,
+                             encode_payload)
+from tsv_index import TsvIndex
+from tsv_reader import iter_chunks
+from encoding_store import FORMAT_PACKED, ensure_schema, get_encoding_row
+from encoding_cache import (INSERT_CACHE_ENTRY, EncodingCache, get_digest,
+                            encode_cached)
+from storage import (GROUP_COMMIT_ROWS, GROUP_COMMIT_SECONDS,
+                     SELECT_IDS_BETWEEN, INSERT_ENCODING, GroupCommit,
+                     connect)
+from stages import QUEUE_BYTES, StageAborted, run_stages
+from coordinator import (COORDINATOR_PATH, Coordinator, LeaseLost,
+                         get_worker_id)
+from merge_shards import (SHARD_DIR, merge_shards, get_shard_db_path,
+                          get_shard_breakpoint_path, get_worker_db_path)
+
 
 ''' Session Control Utilities '''
 
 CHUNK_SIZE = int(1e4)
-PROCESSES_COUNT = 7
+PROCESSES_COUNT = 1
+# how faces are detected and encoded, see `encoding_server.py`
+EXTRACT_OPTIONS = DEFAULT_OPTIONS
+# overlap reading, encoding and writing, see `stages.py`
+STAGED = False
+# take ranges leased from the coordinator instead of a breakpoint, see
+# `coordinator.py`
+COORDINATE = False
+WORKER_ID = None
 
 SOURCE_DIR = os.path.join(os.pardir, 'FaceImageCroppedWithoutAlignment.tsv')
 DB_PATH = os.path.join(os.curdir, 'encodings.db')
@@ -37,9 +53,19 @@ BREAKPOINT_PATH = os.path.join(os.curdir, 'bkpt')
 range_start = 0
 range_end = -1
 
+# blob format of the target database, see `encoding_store.py`
+encoding_format = FORMAT_PACKED
+# commits and saves breakpoint every few chunks, created in `main()`
+group_commit = None
+# content-hash -> encodings cache, created in `main()`, `None` if disabled
+encoding_cache = None
+# distinguishes cache entries of non-default `EXTRACT_OPTIONS`
+cache_salt = b''
+
 
-def load_breakpoint(path=BREAKPOINT_PATH):
+def load_breakpoint(path=None):
     global range_start
+    path = path or BREAKPOINT_PATH
     try:
         with open(path, 'r') as f:
             range_start = int(f.read())
@@ -49,8 +75,9 @@ def load_breakpoint(path=BREAKPOINT_PATH):
         range_start = 0
 
 
-def save_breakpoint(path=BREAKPOINT_PATH):
+def save_breakpoint(path=None):
     global range_start
+    path = path or BREAKPOINT_PATH
     try:
         with open(path, 'r') as f:
             old_breakpoint = int(f.read())
@@ -65,25 +92,18 @@ def save_breakpoint(path=BREAKPOINT_PATH):
             f.write(str(range_start - 1))   # `-1` for safe
 
 
-''' Helper Functions - Data Format '''
-
-get_rec_uid = lambda rec: rec.name
-get_rec_format = lambda rec: rec[2].split('.')[-1]
-
+def on_commit():
+    # progress of leased ranges is kept by the coordinator
+    if not COORDINATE:
+        save_breakpoint()
+    if encoding_cache is not None:
+        print(encoding_cache.report())
 
-''' Helper Functions - Image Processing '''
 
-def convert_rec_to_ndarray(rec, format='jpg'):
-    '''
-    read base64 image from record as `np.ndarray`
+''' Helper Functions - Data Format '''
 
-    :param rec: raw record from `FaceImageCroppedWithOutAlignment.tsv`
-    :param format: base64 image format
-    :return: `np.ndarray` of shape `[width, height, channels]`
-    '''
-    img = mpimage.imread(io.BytesIO(base64.b64decode(rec[6])), format=format)
-    img.setflags(write=True)
-    return img
+get_rec_uid = lambda rec: rec.idx
+get_rec_format = lambda rec: rec.url.split('.')[-1]
 
 
 ''' Record Process '''
@@ -98,75 +118,60 @@ def process_record(db_cursor, idx, rec):
     '''
     # get **unique** id of current image, must match that in `orig_reader`
     # NOTE: `rec[1]` is not unique!
-    # HACK: using `iloc` in `orig_idx`, this requires that orders in
+    # HACK: using line number as `rec.idx`, this requires that orders in
     #       original data does **NOT** change
     rec_uid = idx
     # skip if already in database
-    SQL = '''
-        SELECT id FROM encodings WHERE id = ?
-    '''
-    db_cursor.execute(SQL, (rec_uid,))
+    db_cursor.execute(SELECT_IDS_BETWEEN, (rec_uid, rec_uid))
     if db_cursor.fetchall():
         print('Current record already in database, skipping...')
     else:
-        # NOTE: believe me, they're all `jpg` images
-        imgarr = convert_rec_to_ndarray(rec, format='jpg')
-        encodings = fr.face_encodings(imgarr)
-        SQL = '''
-            INSERT INTO encodings (id, encoding) VALUES (?, ?)
-        '''
-        db_cursor.execute(SQL, (rec_uid,
-                                sqlite3.Binary(pickle.dumps(encodings)))
-        )
+        faces = None
+        if encoding_cache is not None:
+            digest = get_digest(rec.image, cache_salt)
+            faces = encoding_cache.get(digest)
+            encoding_cache.record(faces is not None, faces is None)
+        if faces is None:
+            # NOTE: believe me, they're all `jpg` images
+            faces = encode_payload(fr, rec.image, EXTRACT_OPTIONS)
+            if encoding_cache is not None:
+                encoding_cache.put(digest, *faces)
+        db_cursor.execute(INSERT_ENCODING,
+                          get_encoding_row(rec_uid, *faces,
+                                           format=encoding_format))
         global range_start
         range_start = rec_uid
 
 
-# def process_records(db_cursor, idxes, recs):
-#     '''
-#     process a bunch of records, using process-parallel while calculateing
-#     face encodings
-
-#     :param db_cursor: database cursor
-#     :param idxes: unique indexes of records
-#     :param records: pool of records to be processed
-#     '''
-#     rec_uids = idxes
-#     # decide records to calculate
-#     if_exist_mask = []
-#     for rec_uid in rec_uids:
-#         SQL = '''
-#             SELECT id FROM encodings WHERE id = ?
-#         '''
-#         db_cursor.execute(SQL, (rec_uid,))
-#         if db_cursor.fetchall():
-#             if_exist_mask.append(True)
-#             print('Record {} already in database, skipping...'
-#                   .format(rec_uid))
-#         else:
-#             if_exist_mask.append(False)
-#     # create job pool
-#     job_rec_uids = [
-#         rec_uids[e] for e in range(len(recs)) if not if_exist_mask[e]
-#     ]
-#     job_records_pool = [
-#         recs[e] for e in range(len(recs)) if not if_exist_mask[e]
-#     ]
-#     # do jobs in parallel
-#     with Pool(processes=PROCESSES_COUNT) as p:
-#         pkls = p.map(
-#             _dump_rec_to_pkl,
-#             job_records_pool
-#         )
-#     # register changes in database cursor
-#     for job_rec_uid, pkl in zip(job_rec_uids, pkls):
-#         SQL = '''
-#             INSERT INTO encodings (id, encoding) VALUES (?, ?)
-#         '''
-#         db_cursor.execute(SQL, (job_rec_uid, sqlite3.Binary(pkl)))
-#     print('Process for {} finished'.format(job_rec_uids))
-#     global range_start
-#     range_start = max(idxes)
+def process_records(db_cursor, server, idxes, recs):
+    '''
+    process a bunch of records, calculating face encodings on the persistent
+    worker pool
+
+    :param db_cursor: database cursor
+    :param server: a started `EncodingServer`
+    :param idxes: unique indexes of records
+    :param recs: records to be processed
+    '''
+    # decide records to calculate
+    db_cursor.execute(SELECT_IDS_BETWEEN, (min(idxes), max(idxes)))
+    existing = set(row[0] for row in db_cursor.fetchall())
+    if existing:
+        print('{} records already in database, skipping...'
+              .format(len(existing)))
+    pending = [(rec_uid, rec.image) for rec_uid, rec in zip(idxes, recs)
+               if rec_uid not in existing]
+    # NOTE: believe me, they're all `jpg` images
+    # only encode payloads neither cached nor repeated in this chunk
+    results = encode_cached(encoding_cache, server.encode, pending,
+                            cache_salt)
+    # register results in database cursor, in order of submission
+    rows = [get_encoding_row(rec_uid, *faces, format=encoding_format)
+            for rec_uid, faces in results]
+    db_cursor.executemany(INSERT_ENCODING, rows)
+    if rows:
+        global range_start
+        range_start = rows[-1][0]
 
 
 ''' Chunk Process '''
@@ -179,60 +184,189 @@ def process_chunk(chunk, db_connection, nop=False):
     :param db_connection: database connection
     :param nop: if `True`, do nothing!
     '''
-    print('Chunk range: {}-{}'.format(chunk.iloc[0].name,
-                                      chunk.iloc[-1].name))
+    print('Chunk range: {}-{}'.format(chunk[0].idx,
+                                      chunk[-1].idx))
     if nop:
         return
-    if range_start > chunk.iloc[-1].name:
+    if range_start > chunk[-1].idx:
         print('Skipping this chunk for it\'s already processed!')
         return
-    elif range_end != -1 and range_end < chunk.iloc[0].name:
+    elif range_end != -1 and range_end < chunk[0].idx:
         print('Reached specified range!')
         return
     else:
-        for orig_idx, rec in chunk.iterrows():
-            print('Processing {}'.format(orig_idx))
+        for rec in chunk:
+            print('Processing {}'.format(rec.idx))
             process_record(db_connection.cursor(),
-                           orig_idx,
+                           rec.idx,
                            rec)
-        save_breakpoint()
-        db_connection.commit()
-        print('Breakpoint {} saved. Loading next chunk...'
-              .format(range_start))
-
-
-# def process_chunk_parallel(chunk, db_connection, nop=False):
-#     print('Chunk range: {}-{}'.format(chunk.iloc[0].name,
-#                                       chunk.iloc[-1].name))
-#     if nop:
-#         return
-#     if range_start > chunk.iloc[-1].name:
-#         print('Skipping this chunk for it\'s already processed!')
-#         return
-#     elif range_end != -1 and range_end < chunk.iloc[0].name:
-#         print('Reached specified range!')
-#         return
-#     else:
-#         idx_pool, rec_pool = [], []
-#         for orig_idx, rec in chunk.iterrows():
-#             idx_pool.append(orig_idx)
-#             rec_pool.append(rec)
-#             if len(idx_pool) == PROCESSES_COUNT:
-#                 print('Forking worker processes...')
-#                 process_records(db_connection.cursor(),
-#                                 idx_pool,
-#                                 rec_pool)
-#                 print('Workers joined, clearing data pool...')
-#                 idx_pool, rec_pool = [], []
-#         if idx_pool:
-#             process_records(db_connection.cursor(),
-#                             idx_pool,
-#                             rec_pool)
-#             # idx_pool, rec_pool = [], []     # HACK: exiting, not needed
-#         save_breakpoint()
-#         db_connection.commit()
-#         print('Breakpoint {} saved. Loading next chunk...'
-#               .format(range_start))
+        if group_commit.add(len(chunk)):
+            print('Breakpoint {} saved.'.format(range_start))
+        print('Loading next chunk...')
+
+
+def process_chunk_parallel(chunk, db_connection, server, nop=False):
+    '''
+    process a chunk of data on the encoding worker pool
+
+    :param chunk: chunk of data
+    :param db_connection: database connection
+    :param server: a started `EncodingServer`
+    :param nop: if `True`, do nothing!
+    '''
+    print('Chunk range: {}-{}'.format(chunk[0].idx,
+                                      chunk[-1].idx))
+    if nop:
+        return
+    if range_start > chunk[-1].idx:
+        print('Skipping this chunk for it\'s already processed!')
+        return
+    elif range_end != -1 and range_end < chunk[0].idx:
+        print('Reached specified range!')
+        return
+    else:
+        idx_pool, rec_pool = [], []
+        for rec in chunk:
+            idx_pool.append(rec.idx)
+            rec_pool.append(rec)
+        process_records(db_connection.cursor(), server, idx_pool, rec_pool)
+        if group_commit.add(len(chunk)):
+            print('Breakpoint {} saved.'.format(range_start))
+        print('Loading next chunk...')
+
+
+''' Staged Process '''
+
+def get_chunk_bytes(chunk):
+    return sum(len(rec.image) for rec in chunk)
+
+
+def get_result_bytes(result):
+    rows, cache_rows = result
+    return sum(len(row[1]) for row in rows) \
+        + sum(len(row[1]) for row in cache_rows)
+
+
+def encode_stage(chunks, db_connection):
+    '''
+    encode chunks read ahead by the reader thread, runs in the main thread
+
+    Only reads from the database, results are handed to `write_stage()`.
+
+    :param chunks: iterator over chunks of data
+    :param db_connection: database connection of the main thread
+    :return: iterator over `(rows, cache_rows)` of each chunk
+    '''
+    with open_encoder(PROCESSES_COUNT, EXTRACT_OPTIONS) as encoder:
+        db_cursor = db_connection.cursor()
+        for chunk in chunks:
+            print('Chunk range: {}-{}'.format(chunk[0].idx, chunk[-1].idx))
+            db_cursor.execute(SELECT_IDS_BETWEEN,
+                              (chunk[0].idx, chunk[-1].idx))
+            existing = set(row[0] for row in db_cursor.fetchall())
+            if existing:
+                print('{} records already in database, skipping...'
+                      .format(len(existing)))
+            pending = [(rec.idx, rec.image) for rec in chunk
+                       if rec.idx not in existing]
+            rows = [get_encoding_row(rec_uid, *faces, format=encoding_format)
+                    for rec_uid, faces in encode_cached(
+                        encoding_cache, encoder.encode, pending, cache_salt)]
+            yield rows, (encoding_cache.take_rows()
+                         if encoding_cache is not None else [])
+
+
+def write_stage(results):
+    '''
+    insert results of `encode_stage()`, runs in the writer thread with a
+    connection of its own, committing and saving breakpoint as usual
+
+    :param results: iterator over `(rows, cache_rows)`
+    '''
+    global group_commit, range_start
+    with connect(DB_PATH) as db_connection:
+        group_commit = GroupCommit(db_connection, rows=GROUP_COMMIT_ROWS,
+                                   seconds=GROUP_COMMIT_SECONDS,
+                                   on_commit=on_commit)
+        db_cursor = db_connection.cursor()
+        try:
+            for rows, cache_rows in results:
+                db_cursor.executemany(INSERT_CACHE_ENTRY, cache_rows)
+                db_cursor.executemany(INSERT_ENCODING, rows)
+                if rows:
+                    range_start = rows[-1][0]
+                if group_commit.add(len(rows)):
+                    print('Breakpoint {} saved.'.format(range_start))
+        except StageAborted:
+            # interrupted between chunks, keep those written
+            pass
+        group_commit.commit()
+
+
+def staged_main(db_connection, orig_reader):
+    '''
+    run extraction as reader, encoder and writer stages, see `stages.py`
+
+    :param db_connection: database connection, only read from
+    :param orig_reader: iterator over chunks of data
+    '''
+    global encoding_cache
+    if encoding_cache is not None:
+        # entries are inserted by the writer thread
+        encoding_cache = EncodingCache(db_connection, deferred=True)
+    try:
+        run_stages(orig_reader,
+                   lambda chunks: encode_stage(chunks, db_connection),
+                   write_stage,
+                   source_sizeof=get_chunk_bytes,
+                   result_sizeof=get_result_bytes,
+                   max_bytes=QUEUE_BYTES)
+        print('All done!')
+    except KeyboardInterrupt:
+        print('Breaked manually!')
+
+
+''' Coordinated Process '''
+
+def coordinated_main(db_connection):
+    '''
+    process ranges of job `'extract'` leased from the coordinator, until all
+    are done
+
+    :param db_connection: database connection of this worker
+    '''
+    global range_start, range_end
+    coordinator = Coordinator(COORDINATOR_PATH, WORKER_ID)
+    try:
+        with open_encoder(PROCESSES_COUNT, EXTRACT_OPTIONS) as encoder:
+            for lease in coordinator.leases('extract'):
+                print('Processing {}...'.format(lease))
+                range_start, range_end = lease.first, lease.last
+                orig_reader = iter_chunks(SOURCE_DIR, columns=('image',),
+                                          start=lease.first,
+                                          stop=lease.last + 1,
+                                          chunksize=CHUNK_SIZE)
+                try:
+                    for chunk in orig_reader:
+                        process_chunk_parallel(chunk, db_connection,
+                                               encoder)
+                        lease.heartbeat()
+                except LeaseLost as e:
+                    # records written so far are still good, keep them
+                    print(e)
+                    continue
+                # the unit is done only once its records are committed
+                group_commit.commit()
+                if not lease.done():
+                    print('{} was leased to another worker meanwhile, left '
+                          'to it.'.format(lease))
+        group_commit.commit()
+        print('All done!')
+    except KeyboardInterrupt:
+        group_commit.commit()
+        print('Breaked manually!')
+    finally:
+        coordinator.close()
 
 
 ''' Main Process '''
@@ -248,34 +382,152 @@ parser.add_argument('-n', '--no-op', action='store_true',
                     help='''Do nothing, just go through the data set.''')
 parser.add_argument('-cs', '--chunk-size', default=int(1e3),
                     help='''Chunk size. Large as your RAM can hold.''')
+parser.add_argument('-p', '--processes', type=int, default=PROCESSES_COUNT,
+                    help='''Number of persistent encoding workers. `1` runs
+encoding in the main process.''')
+parser.add_argument('--shard', nargs=2, type=int, metavar=('I', 'N'),
+                    help='''Process only the I-th of N equal slices of the
+data set, writing to its own shard database and breakpoint. Requires
+`tsv_index.py` to be run first.''')
+parser.add_argument('--commit-rows', type=int, default=GROUP_COMMIT_ROWS,
+                    help='''Commit and save breakpoint after this many
+records...''')
+parser.add_argument('--commit-seconds', type=float,
+                    default=GROUP_COMMIT_SECONDS,
+                    help='''...or this many seconds, whichever comes
+first.''')
+parser.add_argument('--faces', choices=FACE_MODES,
+                    default=DEFAULT_OPTIONS.mode,
+                    help='''Encode all faces detected, or only the largest
+one. `count` always records the number of faces detected.''')
+parser.add_argument('--max-faces', type=int,
+                    help='''Encode nothing for images with more faces
+detected than this.''')
+parser.add_argument('--upsample', type=int, default=DEFAULT_OPTIONS.upsample,
+                    help='''Times to upsample images when detecting faces,
+higher finds smaller faces but is slower.''')
+parser.add_argument('--detector', choices=DETECTOR_MODELS,
+                    default=DEFAULT_OPTIONS.model,
+                    help='''Face detector, `cnn` is more accurate but needs a
+GPU to be fast.''')
+parser.add_argument('--max-size', type=int, default=DEFAULT_OPTIONS.max_size,
+                    help='''Decode images at reduced resolution, no smaller
+than this on the longer side, to speed up face detection.''')
+parser.add_argument('--no-cache', action='store_true',
+                    help='''Do not look up or fill the content-hash encoding
+cache, see `encoding_cache.py`.''')
+parser.add_argument('--staged', action='store_true',
+                    help='''Read, encode and write in overlapping stages: a
+reader thread, the encoding workers and a database writer thread.''')
+parser.add_argument('--queue-mb', type=int, default=QUEUE_BYTES >> 20,
+                    help='''Megabytes of chunks or results queued between two
+stages, bounding memory use with `--staged`.''')
+parser.add_argument('--coordinate', action='store_true',
+                    help='''Process ranges leased from the coordinator until
+all are done, writing to a database of this worker under `shards/`, see
+`coordinator.py`.''')
+parser.add_argument('--coordinator', default=COORDINATOR_PATH,
+                    help='''Coordinator database on the shared
+filesystem.''')
+parser.add_argument('--worker-id',
+                    help='''Name of this worker, `<host>-<pid>` by
+default.''')
+parser.add_argument('--shards', type=int, metavar='N',
+                    help='''Launch N shard workers in parallel and merge their
+databases into the top-level database once they all finish.''')
 
 args = parser.parse_args()
 print(args)
 
+if args.shard is not None:
+    shard, shards_count = args.shard
+    index = TsvIndex.load(SOURCE_DIR)
+    if index is None:
+        raise RuntimeError('Sharding requires an index, run `tsv_index.py`!')
+    shard_start = len(index) * shard // shards_count
+    shard_end = len(index) * (shard + 1) // shards_count - 1
+    if not os.path.exists(SHARD_DIR):
+        os.mkdir(SHARD_DIR)
+    DB_PATH = get_shard_db_path(shard, shards_count)
+    BREAKPOINT_PATH = get_shard_breakpoint_path(shard, shards_count)
+    print('Shard {} of {}: records {}-{}'
+          .format(shard, shards_count, shard_start, shard_end))
+if args.coordinate:
+    COORDINATE = True
+    COORDINATOR_PATH = args.coordinator
+    WORKER_ID = args.worker_id or get_worker_id()
+    if not os.path.exists(SHARD_DIR):
+        os.mkdir(SHARD_DIR)
+    DB_PATH = get_worker_db_path(WORKER_ID)
+    print('Worker {}, writing to \'{}\''.format(WORKER_ID, DB_PATH))
 if args.range is not None:
     range_start = args.range[0]
     range_end = args.range[1]
-else:
+elif args.shard is not None:
+    load_breakpoint()
+    range_start = max(range_start, shard_start)
+    range_end = shard_end
+elif not args.coordinate:
     load_breakpoint()
     range_end = -1
 
 NOP = args.no_op
 CHUNK_SIZE = int(args.chunk_size)
+PROCESSES_COUNT = args.processes
+EXTRACT_OPTIONS = DEFAULT_OPTIONS._replace(
+    mode=args.faces, max_faces=args.max_faces, upsample=args.upsample,
+    model=args.detector, max_size=args.max_size)
+cache_salt = get_options_salt(EXTRACT_OPTIONS)
+GROUP_COMMIT_ROWS = args.commit_rows
+GROUP_COMMIT_SECONDS = args.commit_seconds
+STAGED = args.staged
+QUEUE_BYTES = args.queue_mb << 20
 
 
 def main(db_connection):
-    orig_reader = pd.read_csv(SOURCE_DIR,
-                              sep='\t', header=None,
+    global group_commit, encoding_cache
+    if not args.no_cache:
+        encoding_cache = EncodingCache(db_connection)
+    group_commit = GroupCommit(db_connection, rows=GROUP_COMMIT_ROWS,
+                               seconds=GROUP_COMMIT_SECONDS,
+                               on_commit=on_commit)
+    if NOP:
+        index = TsvIndex.load(SOURCE_DIR)
+        if index is not None:
+            print('{} records in total (from index).'.format(len(index)))
+            return
+    if not NOP and COORDINATE:
+        coordinated_main(db_connection)
+        return
+    stop = None if range_end == -1 else range_end + 1
+    # NOTE: only count records when doing nothing, skip the heavy base64
+    orig_reader = iter_chunks(SOURCE_DIR,
+                              columns=('segment',) if NOP else ('image',),
+                              start=0 if NOP else range_start, stop=stop,
                               chunksize=CHUNK_SIZE)
-    if not NOP:
+    if not NOP and STAGED:
+        staged_main(db_connection, orig_reader)
+    elif not NOP and PROCESSES_COUNT > 1:
+        try:
+            with EncodingServer(processes=PROCESSES_COUNT,
+                                options=EXTRACT_OPTIONS) as server:
+                for chunk in orig_reader:
+                    print('Processing chunk...')
+                    process_chunk_parallel(chunk, db_connection, server)
+            group_commit.commit()
+            print('All done!')
+        except KeyboardInterrupt:
+            group_commit.commit()
+            print('Breaked manually!')
+    elif not NOP:
         try:
             for chunk in orig_reader:
                 print('Processing chunk...')
                 process_chunk(chunk, db_connection)
+            group_commit.commit()
             print('All done!')
         except KeyboardInterrupt:
-            save_breakpoint()
-            db_connection.commit()
+            group_commit.commit()
             print('Breaked manually!')
     else:
         for chunk in orig_reader:
@@ -283,15 +535,47 @@ def main(db_connection):
         print('All done!')
 
 
-if __name__ == '__main__':
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS encodings (
-                id          integer     primary key     ,
-                encoding    blob        not null        ,
-                belong      integer
-            )'''
-        )
+def run_shards(shards_count):
+    '''
+    run `shards_count` shard workers as subprocesses, then merge the shards
+
+    :param shards_count: number of shards
+    '''
+    passthrough = ['--chunk-size', str(CHUNK_SIZE),
+                   '--processes', str(PROCESSES_COUNT),
+                   '--commit-rows', str(GROUP_COMMIT_ROWS),
+                   '--commit-seconds', str(GROUP_COMMIT_SECONDS)]
+    passthrough += ['--faces', EXTRACT_OPTIONS.mode,
+                    '--upsample', str(EXTRACT_OPTIONS.upsample),
+                    '--detector', EXTRACT_OPTIONS.model]
+    if EXTRACT_OPTIONS.max_faces is not None:
+        passthrough += ['--max-faces', str(EXTRACT_OPTIONS.max_faces)]
+    if EXTRACT_OPTIONS.max_size is not None:
+        passthrough += ['--max-size', str(EXTRACT_OPTIONS.max_size)]
+    if args.no_cache:
+        passthrough.append('--no-cache')
+    if STAGED:
+        passthrough += ['--staged', '--queue-mb', str(args.queue_mb)]
+    workers = [
+        subprocess.Popen([sys.executable, sys.argv[0],
+                          '--shard', str(shard), str(shards_count)]
+                         + passthrough)
+        for shard in range(shards_count)
+    ]
+    failed = [shard for shard, worker in enumerate(workers)
+              if worker.wait() != 0]
+    if failed:
+        print('Shards {} failed, rerun them with `--shard I {}` before '
+              'merging!'.format(failed, shards_count))
+        return
+    merge_shards([get_shard_db_path(shard, shards_count)
+                  for shard in range(shards_count)])
+
+
+if __name__ == '__main__' and args.shards is not None:
+    run_shards(args.shards)
+elif __name__ == '__main__':
+    with connect(DB_PATH) as conn:
+        encoding_format = ensure_schema(conn)
 
         main(conn)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Image decode stage, base64 payload -> contiguous `uint8` RGB `np.ndarray`.
+
+Built directly on PIL instead of `matplotlib.image.imread`, which is slow to
+import, goes through a `BytesIO` round trip per image and returns read-only
+arrays that had to be made writable. With `max_size` set, JPEGs are decoded
+with `Image.draft()`, which lets libjpeg scale down by 1/2, 1/4 or 1/8 in the
+DCT domain, so face detection could run on smaller images at a fraction of
+the decode cost. The decoded image is never smaller than `max_size` on its
+longer side, unless the original is.
+
+See `benchmarks/bench_decode.py` for throughput and encoding agreement.
+'''
+
+import io
+import base64
+
+import numpy as np
+from PIL import Image
+
+
+''' Configurations '''
+
+# longest side to decode at, `None` for full resolution
+MAX_SIZE = None
+
+
+''' Decode '''
+
+def open_image(payload):
+    '''
+    Args:
+        `payload`: base64 `str` or raw image `bytes`
+
+    Return:
+        lazily decoded `PIL.Image.Image`
+    '''
+    if isinstance(payload, str):
+        payload = base64.b64decode(payload)
+    return Image.open(io.BytesIO(payload))
+
+
+def decode_image_scaled(payload, max_size=MAX_SIZE):
+    '''
+    decode an image payload, possibly at reduced resolution
+
+    Args:
+        `payload`: base64 `str` or raw image `bytes`
+        `max_size`: longest side to decode at, `None` for full resolution
+
+    Return:
+        `(image, scale)`, `image` being writable `np.ndarray` of shape
+        `[height, width, 3]` and dtype `uint8`, `scale` being original width
+        over decoded width, i.e. `1.` unless downscaled
+    '''
+    img = open_image(payload)
+    width, height = img.size
+    if max_size is not None and max(width, height) > max_size:
+        # NOTE: `draft()` keeps both sides no smaller than requested, and
+        #       only JPEG supports it, others are decoded as is
+        ratio = max_size / max(width, height)
+        img.draft('RGB', (int(np.ceil(width * ratio)),
+                          int(np.ceil(height * ratio))))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    arr = np.array(img, dtype=np.uint8)
+    return arr, width / arr.shape[1]
+
+
+def decode_image(payload, max_size=MAX_SIZE):
+    '''
+    decode an image payload as writable `uint8` RGB `np.ndarray`, see
+    `decode_image_scaled()`
+    '''
+    return decode_image_scaled(payload, max_size)[0]
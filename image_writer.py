@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Background writer stage for dumping images to folders.
+
+Decoding base64 and writing millions of small files is slow, and the main loop
+used to wait on every one of them. Here the work is handed to a small thread
+pool through a bounded queue, so classification keeps going while files are
+written, and memory stays capped when the disk falls behind. Directories
+already created are remembered, so `os.path.exists()` / `os.mkdir()` are
+called once per directory rather than once per image.
+
+Use `open_image_writer()` to choose between this and the packed output of
+`packed_output.py`, both expose `write_record()`, `flush()` and `close()`.
+'''
+
+import os
+import base64
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from packed_output import PackedImageWriter
+
+
+''' Configurations '''
+
+WRITER_THREADS = 4
+# max images waiting to be written
+QUEUE_SIZE = 1024
+
+# `'folders'` for one file per image, `'packed'` for tar shards
+OUTPUT_MODES = ('folders', 'packed')
+
+
+''' Writer '''
+
+class AsyncImageWriter(object):
+    '''
+    write base64 images to files on a background thread pool
+
+    Usage::
+
+        with AsyncImageWriter() as writer:
+            writer.write(target_dir, '{}.jpg'.format(idx), rec.image)
+            ...
+            writer.flush()      # before saving a breakpoint
+
+    `write()` blocks when `queue_size` images are already pending. Errors
+    raised in writer threads are re-raised on the next `flush()`.
+    '''
+
+    def __init__(self, threads=WRITER_THREADS, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._dirs = set()
+        self._dirs_lock = threading.Lock()
+        self._errors = []
+
+    def _ensure_dir(self, target_dir):
+        if target_dir in self._dirs:
+            return
+        with self._dirs_lock:
+            if target_dir not in self._dirs:
+                os.makedirs(target_dir, exist_ok=True)
+                self._dirs.add(target_dir)
+
+    def _write(self, target_dir, filename, payload):
+        try:
+            self._ensure_dir(target_dir)
+            if isinstance(payload, str):
+                payload = base64.b64decode(payload)
+            with open(os.path.join(target_dir, filename), 'wb') as f:
+                f.write(payload)
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            self._slots.release()
+
+    def write(self, target_dir, filename, payload):
+        '''
+        queue an image to be written
+
+        Args:
+            `target_dir`: directory of the file, created if not exists
+            `filename`: file name
+            `payload`: base64 `str` or raw image `bytes`
+        '''
+        self._slots.acquire()
+        self._executor.submit(self._write, target_dir, filename, payload)
+
+    def flush(self):
+        '''
+        block until all queued images are written
+        '''
+        for _ in range(self.queue_size):
+            self._slots.acquire()
+        for _ in range(self.queue_size):
+            self._slots.release()
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FolderImageWriter(AsyncImageWriter):
+    '''
+    write images as `<root>/<segment>/<class>/<id>.<format>` files
+    '''
+
+    def __init__(self, root, **kwargs):
+        super(FolderImageWriter, self).__init__(**kwargs)
+        self.root = root
+
+    def write_record(self, segment, klass, idx, payload, format='jpg'):
+        '''
+        queue an image to be written
+
+        Args:
+            `segment`: segment of the record, `None` to skip this level
+            `klass`: class ID of the record, `None` to skip this level
+            `idx`: record id
+            `payload`: base64 `str` or raw image `bytes`
+            `format`: image format
+        '''
+        parts = [str(part) for part in (segment, klass) if part is not None]
+        self.write(os.path.join(self.root, *parts),
+                   '{}.{}'.format(idx, format), payload)
+
+
+def open_image_writer(root, mode='folders'):
+    '''
+    open an image writer for dumping classified images
+
+    Args:
+        `root`: output root directory
+        `mode`: one of `OUTPUT_MODES`
+
+    Return:
+        `FolderImageWriter` or `PackedImageWriter`
+    '''
+    if mode == 'folders':
+        return FolderImageWriter(root)
+    elif mode == 'packed':
+        return PackedImageWriter(root)
+    raise ValueError('Unknown output mode \'{}\'!'.format(mode))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Merge shard databases written by `extract_to_db.py --shard I N` into
+`encodings.db`.
+
+Usage::
+
+    python merge_shards.py [shard.db ...]
+
+With no arguments, every `.db` file under `SHARD_DIR` is merged.
+'''
+
+import os
+import sys
+import glob
+
+from encoding_store import ensure_schema, get_encoding_format
+from encoding_cache import copy_cache
+from storage import connect
+
+
+''' Configurations '''
+
+DB_PATH = os.path.join(os.curdir, 'encodings.db')
+SHARD_DIR = os.path.join(os.curdir, 'shards')
+
+
+''' Helper Functions '''
+
+def get_shard_db_path(shard, shards_count, shard_dir=SHARD_DIR):
+    return os.path.join(shard_dir,
+                        'encodings.{}-of-{}.db'.format(shard, shards_count))
+
+
+def get_shard_breakpoint_path(shard, shards_count, shard_dir=SHARD_DIR):
+    return os.path.join(shard_dir,
+                        'bkpt.{}-of-{}'.format(shard, shards_count))
+
+
+def get_worker_db_path(worker_id, shard_dir=SHARD_DIR):
+    '''
+    database of a worker of `extract_to_db.py --coordinate`
+    '''
+    return os.path.join(shard_dir, 'encodings.{}.db'.format(worker_id))
+
+
+def get_table_columns(db_cursor, table, schema='main'):
+    db_cursor.execute('PRAGMA {}.table_info({})'.format(schema, table))
+    return [row[1] for row in db_cursor.fetchall()]
+
+
+''' Merge '''
+
+def merge_shard(db_connection, shard_path):
+    '''
+    bulk-copy all rows of `encodings` in a shard database into the top-level
+    database, rows already in the top-level database are kept untouched
+
+    Args:
+        `db_connection`: top-level database connection
+        `shard_path`: path to shard database
+
+    Return:
+        number of rows merged
+    '''
+    c = db_connection.cursor()
+    c.execute('ATTACH DATABASE ? AS shard', (shard_path,))
+    try:
+        c.execute('PRAGMA shard.user_version')
+        if c.fetchone()[0] != get_encoding_format(c):
+            raise ValueError('Encoding format of \'{}\' differs from the '
+                             'top-level database, migrate it first!'
+                             .format(shard_path))
+        # only copy columns both sides know about
+        shard_columns = set(get_table_columns(c, 'encodings', 'shard'))
+        columns = ', '.join(col for col in get_table_columns(c, 'encodings')
+                            if col in shard_columns)
+        c.execute(
+            '''
+            INSERT OR IGNORE INTO main.encodings ({0})
+            SELECT {0} FROM shard.encodings
+            '''.format(columns)
+        )
+        merged = c.rowcount
+        db_connection.commit()
+    finally:
+        c.execute('DETACH DATABASE shard')
+    print('Merged {} rows from \'{}\'.'.format(merged, shard_path))
+    return merged
+
+
+def merge_shards(shard_paths, db_path=DB_PATH):
+    with connect(db_path) as db_connection:
+        ensure_schema(db_connection)
+        total = 0
+        for shard_path in shard_paths:
+            total += merge_shard(db_connection, shard_path)
+            # keep encodings cached by shards for later runs
+            cached = copy_cache(db_connection, shard_path)
+            print('Merged {} cache entries from \'{}\'.'
+                  .format(cached, shard_path))
+    print('{} rows merged in total.'.format(total))
+    return total
+
+
+''' Main '''
+
+if __name__ == '__main__':
+    shard_paths = sys.argv[1:] or sorted(
+        glob.glob(os.path.join(SHARD_DIR, '*.db')))
+    merge_shards(shard_paths)
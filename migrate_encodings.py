@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Convert a legacy `encodings.db` (pickled encoding lists) to the packed
+`float32` format, see `encoding_store.py`.
+
+Rows are copied in batches into a new table, which is then swapped in with a
+single transaction, so the conversion could be interrupted and resumed at any
+time. Run with `--vacuum` to give the freed pages back to the file system.
+
+Usage::
+
+    python migrate_encodings.py [--db ./encodings.db] [--vacuum]
+'''
+
+import argparse
+
+from encoding_store import (FORMAT_PICKLE, FORMAT_PACKED, ENCODING_COLUMNS,
+                            ensure_schema, create_encodings_table,
+                            get_encoding_format, set_encoding_format,
+                            pack_encodings, unpack_encodings)
+from storage import connect
+
+
+''' Configurations '''
+
+DB_PATH = './encodings.db'
+BATCH_SIZE = int(1e4)
+
+
+''' Migration '''
+
+def copy_batch(db_cursor, last_id, batch_size=BATCH_SIZE):
+    '''
+    convert and copy the next batch of rows after `last_id`
+
+    All columns are copied as they are, `count` (faces detected, which may
+    differ from faces encoded, see `extract_to_db.py`) falls back to the
+    number of encodings only where missing.
+
+    Return:
+        id of the last copied row, or `None` if nothing is left
+    '''
+    columns = ', '.join(ENCODING_COLUMNS)
+    db_cursor.execute(
+        '''
+        SELECT {} FROM encodings
+        WHERE
+            id > ?
+        ORDER BY id
+        LIMIT ?
+        '''.format(columns),
+        (last_id, batch_size)
+    )
+    rows = db_cursor.fetchall()
+    if not rows:
+        return None
+    converted = []
+    for idx, blob, belong, orig_class, count, *box in rows:
+        encodings = unpack_encodings(blob, FORMAT_PICKLE)
+        if count is None:
+            count = len(encodings)
+        converted.append([idx, pack_encodings(encodings, FORMAT_PACKED),
+                          belong, orig_class, count] + box)
+    db_cursor.executemany(
+        '''
+        INSERT INTO encodings_packed ({})
+        VALUES ({})
+        '''.format(columns, ', '.join('?' * len(ENCODING_COLUMNS))),
+        converted
+    )
+    return rows[-1][0]
+
+
+def migrate(db_path=DB_PATH, vacuum=False):
+    with connect(db_path) as db_connection:
+        c = db_connection.cursor()
+        if get_encoding_format(c) == FORMAT_PACKED:
+            print('\'{}\' is already packed, nothing to do.'.format(db_path))
+            return
+        ensure_schema(db_connection)
+        # a table left by an older version lacks columns, start it over
+        c.execute('PRAGMA table_info(encodings_packed)')
+        columns = [row[1] for row in c.fetchall()]
+        if columns and tuple(columns) != ENCODING_COLUMNS:
+            c.execute('DROP TABLE encodings_packed')
+        create_encodings_table(c, 'encodings_packed')
+        # resume from where the last run stopped
+        c.execute('SELECT MAX(id) FROM encodings_packed')
+        last_id = c.fetchone()[0]
+        last_id = -1 if last_id is None else last_id
+        while True:
+            last_id = copy_batch(c, last_id)
+            db_connection.commit()
+            if last_id is None:
+                break
+            print('Converted up to id {}...'.format(last_id))
+        # swap tables
+        # NOTE: indexes on the old table are dropped along with it!
+        c.execute('BEGIN')
+        c.execute('DROP TABLE encodings')
+        c.execute('ALTER TABLE encodings_packed RENAME TO encodings')
+        set_encoding_format(c, FORMAT_PACKED)
+        db_connection.commit()
+        print('\'{}\' migrated to packed format.'.format(db_path))
+        if vacuum:
+            print('Vacuuming...')
+            c.execute('VACUUM')
+
+
+''' Main '''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='''Convert pickled encodings in `encodings.db` to packed
+`float32` vectors.'''
+    )
+    parser.add_argument('--db', default=DB_PATH,
+                        help='''Path to `encodings.db`.''')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='''Run `VACUUM` after migration.''')
+    args = parser.parse_args()
+    migrate(args.db, vacuum=args.vacuum)
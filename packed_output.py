@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Packed output mode: append dumped images to a few hundred `.tar` shards
+instead of writing millions of tiny files.
+
+Every segment is hashed to one of `SHARDS_COUNT` shards under the output root
+(every class, or else every record, when dumped without segments, as by
+`dump_folders.py` and `dump_similar.py`). Images are appended as
+`<segment>/<class>/<id>.jpg` members, and their positions are recorded in
+`index.db`::
+
+    images (
+        segment     text    ,       -- '' if not classified by segment
+        klass       text    ,       -- '' if not classified at all
+        id          integer ,       -- record id
+        shard       integer ,       -- shard number, see `get_shard_path()`
+        offset      integer ,       -- byte offset of image data in shard
+        length      integer         -- byte length of image data
+    )
+
+Rows are keyed by `(segment, klass, id)`, as a record may be dumped to several
+classes, e.g. as a hit of several queries in `dump_similar.py`.
+
+Shards are plain tar files, so `tar xf` still gives the usual folder layout,
+while the index allows extracting a single class, or streaming over all
+images, with plain seeks.
+
+Usage::
+
+    python packed_output.py list    <root>
+    python packed_output.py extract <root> <segment> <class> <target_dir>
+'''
+
+import io
+import os
+import sys
+import time
+import base64
+import tarfile
+import zlib
+
+from storage import connect
+
+
+''' Configurations '''
+
+SHARDS_COUNT = 256
+INDEX_NAME = 'index.db'
+
+
+''' Helper Functions '''
+
+def get_shard_path(root, shard):
+    return os.path.join(root, 'shard-{:04d}.tar'.format(shard))
+
+
+def get_shard_of_record(segment, klass, idx, shards_count=SHARDS_COUNT):
+    '''
+    shard of a record by its segment, or its class if not segmented, or its
+    id if not classified either, so that output without segments is spread
+    over all shards too
+    '''
+    key = segment or klass or str(idx)
+    return zlib.crc32(key.encode('utf-8')) % shards_count
+
+
+def create_images_table(conn, table='images'):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS {} (
+            segment     text        not null    ,
+            klass       text        not null    ,
+            id          integer     not null    ,
+            shard       integer     not null    ,
+            offset      integer     not null    ,
+            length      integer     not null    ,
+            PRIMARY KEY (segment, klass, id)
+        )'''.format(table)
+    )
+
+
+def open_index(root):
+    '''
+    open `index.db` of `root`, upgrading an index keyed by `(segment, id)`
+    only, where a record written to several classes (e.g. hits of several
+    queries in `dump_similar.py`) kept the last one
+    '''
+    conn = connect(os.path.join(root, INDEX_NAME))
+    keys = [row[1] for row in conn.execute('PRAGMA table_info(images)')
+            if row[5]]
+    if keys and 'klass' not in keys:
+        create_images_table(conn, 'images_upgraded')
+        conn.execute('INSERT INTO images_upgraded SELECT segment, klass, id, '
+                     'shard, offset, length FROM images')
+        conn.execute('DROP TABLE images')
+        conn.execute('ALTER TABLE images_upgraded RENAME TO images')
+        conn.commit()
+    create_images_table(conn)
+    # superseded by the primary key
+    conn.execute('DROP INDEX IF EXISTS images_class')
+    return conn
+
+
+def recover_shard(path):
+    '''
+    truncate a shard after its last complete member, and end the archive
+
+    A shard of a crashed session lacks the end-of-archive blocks, and may end
+    in a partly written member, so `tarfile` refuses to append to it. Index
+    rows are only committed for flushed members, which are all kept.
+
+    Return:
+        bytes of members kept
+    '''
+    block = tarfile.BLOCKSIZE
+    end = 0
+    with open(path, 'r+b') as f:
+        size = os.fstat(f.fileno()).st_size
+        while end + block <= size:
+            f.seek(end)
+            try:
+                info = tarfile.TarInfo.frombuf(f.read(block), tarfile.ENCODING,
+                                               'surrogateescape')
+            except tarfile.HeaderError:
+                # end-of-archive blocks, or a partly written header
+                break
+            member_end = end + block + (info.size + block - 1) // block * block
+            if member_end > size:
+                break
+            end = member_end
+        f.seek(end)
+        f.truncate()
+        if end:
+            f.write(tarfile.NUL * block * 2)
+    return end
+
+
+''' Writer '''
+
+class PackedImageWriter(object):
+    '''
+    append images to tar shards, indexed by segment, class and record id
+
+    Index rows are only committed on `flush()`, so call it right before saving
+    a breakpoint. Images re-written after a crash are appended again, and the
+    index points to the latest copy. Shards left unclosed by a crash are
+    repaired with `recover_shard()` when reopened.
+    '''
+
+    def __init__(self, root, shards_count=SHARDS_COUNT):
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.root = root
+        self.shards_count = shards_count
+        self._shards = {}
+        self._pending = []
+        self._index = open_index(root)
+
+    def _get_shard(self, shard):
+        tar = self._shards.get(shard)
+        if tar is None:
+            path = get_shard_path(self.root, shard)
+            append = os.path.exists(path) and recover_shard(path)
+            tar = tarfile.open(path, 'a' if append else 'w',
+                               format=tarfile.USTAR_FORMAT)
+            self._shards[shard] = tar
+        return tar
+
+    def write_record(self, segment, klass, idx, payload, format='jpg'):
+        '''
+        append an image to its shard
+
+        Args:
+            `segment`: segment of the record, `None` if not segmented
+            `klass`: class ID of the record, `None` if not classified
+            `idx`: record id
+            `payload`: base64 `str` or raw image `bytes`
+            `format`: image format
+        '''
+        segment = '' if segment is None else str(segment)
+        klass = '' if klass is None else str(klass)
+        if isinstance(payload, str):
+            payload = base64.b64decode(payload)
+        shard = get_shard_of_record(segment, klass, idx, self.shards_count)
+        tar = self._get_shard(shard)
+        name = '/'.join(part for part in (segment, klass) if part)
+        info = tarfile.TarInfo('{}{}.{}'.format(name + '/' if name else '',
+                                                idx, format))
+        info.size = len(payload)
+        info.mtime = int(time.time())
+        header_offset = tar.offset
+        tar.addfile(info, io.BytesIO(payload))
+        offset = header_offset + len(info.tobuf(tar.format, tar.encoding,
+                                                tar.errors))
+        self._pending.append((segment, klass, int(idx), shard, offset,
+                              len(payload)))
+
+    def flush(self):
+        '''
+        flush shards to disk and commit index rows
+        '''
+        for tar in self._shards.values():
+            tar.fileobj.flush()
+        self._index.executemany(
+            '''
+            INSERT OR REPLACE INTO images
+                (segment, klass, id, shard, offset, length)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''',
+            self._pending
+        )
+        self._index.commit()
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        for tar in self._shards.values():
+            tar.close()
+        self._shards = {}
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+''' Reader '''
+
+class PackedImageReader(object):
+    '''
+    random access and streaming over packed output
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self._index = open_index(root)
+        self._shards = {}
+
+    def _read(self, shard, offset, length):
+        f = self._shards.get(shard)
+        if f is None:
+            f = self._shards[shard] = open(get_shard_path(self.root, shard),
+                                           'rb')
+        f.seek(offset)
+        return f.read(length)
+
+    def list_classes(self):
+        '''
+        Return:
+            `[ (segment, klass, count) ]`
+        '''
+        return self._index.execute('''
+            SELECT segment, klass, COUNT(*) FROM images
+            GROUP BY segment, klass
+        ''').fetchall()
+
+    def iter_class(self, segment, klass):
+        '''
+        iterate over images of one class
+
+        Return:
+            iterator over `(id, bytes)`
+        '''
+        rows = self._index.execute(
+            '''
+            SELECT id, shard, offset, length FROM images
+            WHERE
+                segment = ? AND klass = ?
+            ORDER BY shard, offset
+            ''',
+            ('' if segment is None else str(segment),
+             '' if klass is None else str(klass))
+        ).fetchall()
+        for idx, shard, offset, length in rows:
+            yield idx, self._read(shard, offset, length)
+
+    def iter_all(self):
+        '''
+        stream over all images in on-disk order
+
+        Return:
+            iterator over `(segment, klass, id, bytes)`
+        '''
+        rows = self._index.execute('''
+            SELECT segment, klass, id, shard, offset, length FROM images
+            ORDER BY shard, offset
+        ''')
+        for segment, klass, idx, shard, offset, length in rows:
+            yield segment, klass, idx, self._read(shard, offset, length)
+
+    def extract_class(self, segment, klass, target_dir, format='jpg'):
+        '''
+        extract images of one class to `target_dir`
+
+        Return:
+            number of images extracted
+        '''
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        count = 0
+        for idx, data in self.iter_class(segment, klass):
+            with open(os.path.join(target_dir,
+                                   '{}.{}'.format(idx, format)), 'wb') as f:
+                f.write(data)
+            count += 1
+        return count
+
+    def close(self):
+        for f in self._shards.values():
+            f.close()
+        self._shards = {}
+        self._index.close()
+
+
+''' Main '''
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'list':
+        reader = PackedImageReader(sys.argv[2])
+        for segment, klass, count in reader.list_classes():
+            print('{}\t{}\t{}'.format(segment, klass, count))
+        reader.close()
+    elif len(sys.argv) == 6 and sys.argv[1] == 'extract':
+        reader = PackedImageReader(sys.argv[2])
+        count = reader.extract_class(sys.argv[3], sys.argv[4], sys.argv[5])
+        print('{} images extracted.'.format(count))
+        reader.close()
+    else:
+        print(__doc__)
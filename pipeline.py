@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Single-pass pipeline: extract, backfill, classify and dump in one read of the
+original `.tsv`.
+
+Run separately, `extract_to_db.py`, `append_orig_class.py`,
+`classify_faces.py` and the dump scripts each parse the whole `.tsv` again.
+Here every chunk is read once, then
+
+    1. encodings of records not yet in `encodings.db` are computed (through
+       the encoding cache, see `encoding_cache.py`), along with their face
+       counts
+    2. `orig_class` is recorded
+    3. the chunk is classified into segment prototypes and dumped, exactly as
+       by `classify_faces.chunk_process()`
+
+and all of it is committed together with the breakpoint of
+`classify_faces.py`, so the stages could still be run on their own, before or
+after, and resume from each other's progress. Records already extracted are
+not encoded again.
+
+With `--global` the chunk is classified by `global_chunk_process()` instead.
+Regular classes are only known at the end in this mode, so dump them
+afterwards with `dump_folders.py`, which only reads their members.
+
+Usage::
+
+    python pipeline.py [--global] [--processes N] [--faces largest] ...
+'''
+
+import os
+import argparse
+
+import classify_faces as cf
+
+from tsv_reader import iter_chunks
+from encoding_server import (PROCESSES_COUNT, FACE_MODES, DETECTOR_MODELS,
+                             DEFAULT_OPTIONS, get_options_salt, open_encoder)
+from encoding_store import ensure_schema, get_encoding_row, fetch_range
+from encoding_cache import EncodingCache, encode_cached
+from image_writer import open_image_writer
+from storage import INSERT_ENCODING, UPDATE_ORIG_CLASS, connect
+
+
+''' Configurations '''
+
+# how faces are detected and encoded, see `encoding_server.py`
+EXTRACT_OPTIONS = DEFAULT_OPTIONS
+USE_CACHE = True
+
+
+''' Processes '''
+
+def extract_chunk(top_db_connection, encoder, encoding_cache, chunk,
+                  salt=b''):
+    '''
+    extract and backfill a chunk, not committed
+
+    Args:
+        `top_db_connection`: top-level database connection
+        `encoder`: started `EncodingServer` or `LocalEncoder`
+        `encoding_cache`: `EncodingCache`, or `None`
+        `chunk`: chunk of records with `segment` and `image`
+        `salt`: cache salt of `EXTRACT_OPTIONS`
+
+    Return:
+        `{ id: blob }` of the chunk, for classification
+    '''
+    c = top_db_connection.cursor()
+    chunk_encodings = fetch_range(c, chunk[0].idx, chunk[-1].idx)
+    pending = [(rec.idx, rec.image) for rec in chunk
+               if rec.idx not in chunk_encodings]
+    if pending:
+        print('Encoding {} records...'.format(len(pending)))
+    rows = [get_encoding_row(idx, *faces, format=cf.encoding_format)
+            for idx, faces in encode_cached(encoding_cache, encoder.encode,
+                                            pending, salt)]
+    c.executemany(INSERT_ENCODING, rows)
+    chunk_encodings.update((row[0], row[1]) for row in rows)
+    c.executemany(UPDATE_ORIG_CLASS,
+                  [(rec.segment, rec.idx) for rec in chunk])
+    return chunk_encodings
+
+
+def main(global_mode=False, processes=1):
+    breakpoints_table = 'global_breakpoints' if global_mode else 'breakpoints'
+    last_breakpoint = cf.load_breakpoint(breakpoints_table)
+    # NOTE: breakpoint is the last record of a finished chunk, `0` for none
+    start = last_breakpoint + 1 if last_breakpoint else 0
+    orig_reader = iter_chunks(cf.ORIGINAL_DATA_PATH,
+                              columns=('segment', 'image'),
+                              start=start, chunksize=cf.CHUNK_SIZE)
+    if not global_mode and not os.path.exists(cf.SEGMENT_DB_DIR):
+        os.makedirs(cf.SEGMENT_DB_DIR)
+    salt = get_options_salt(EXTRACT_OPTIONS)
+
+    with connect(cf.TOP_DB_PATH) as top_db_connection, \
+            open_encoder(processes, EXTRACT_OPTIONS) as encoder:
+        cf.encoding_format = ensure_schema(top_db_connection)
+        encoding_cache = EncodingCache(top_db_connection) if USE_CACHE \
+            else None
+        if global_mode:
+            top_db_cursor = top_db_connection.cursor()
+            cf.create_seen_classes(top_db_connection)
+            prototypes = cf.load_prototypes(top_db_cursor, top_db_cursor)
+            for chunk in orig_reader:
+                chunk_encodings = extract_chunk(top_db_connection, encoder,
+                                                encoding_cache, chunk, salt)
+                cf.global_chunk_process(top_db_connection, prototypes, chunk,
+                                        last_breakpoint, chunk_encodings)
+                if encoding_cache is not None:
+                    print(encoding_cache.report())
+            return
+        with open_image_writer(cf.OUTPUT_ROOT_PATH,
+                               cf.OUTPUT_MODE) as cf.image_writer, \
+                cf.SegmentPool(cf.SEGMENT_POOL_SIZE) as cf.segment_pool:
+            classified_segments = cf.load_classified_segments(
+                top_db_connection)
+            for chunk in orig_reader:
+                chunk_encodings = extract_chunk(top_db_connection, encoder,
+                                                encoding_cache, chunk, salt)
+                cf.chunk_process(top_db_connection, chunk, last_breakpoint,
+                                 chunk_encodings, classified_segments)
+                if encoding_cache is not None:
+                    print(encoding_cache.report())
+
+
+''' Main '''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='''Extract, classify and dump in a single pass over the
+original data.''')
+    parser.add_argument('--global', dest='global_mode', action='store_true',
+                        help='''Classify across the entire dataset, see
+`classify_faces.py --global`.''')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='''Number of persistent encoding workers, up to
+{} on this machine.'''.format(PROCESSES_COUNT))
+    parser.add_argument('--faces', choices=FACE_MODES,
+                        default=DEFAULT_OPTIONS.mode,
+                        help='''See `extract_to_db.py`.''')
+    parser.add_argument('--max-faces', type=int,
+                        help='''See `extract_to_db.py`.''')
+    parser.add_argument('--upsample', type=int,
+                        default=DEFAULT_OPTIONS.upsample,
+                        help='''See `extract_to_db.py`.''')
+    parser.add_argument('--detector', choices=DETECTOR_MODELS,
+                        default=DEFAULT_OPTIONS.model,
+                        help='''See `extract_to_db.py`.''')
+    parser.add_argument('--max-size', type=int,
+                        default=DEFAULT_OPTIONS.max_size,
+                        help='''See `extract_to_db.py`.''')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='''See `extract_to_db.py`.''')
+    parser.add_argument('--ann', action='store_true',
+                        help='''See `classify_faces.py`.''')
+    parser.add_argument('--ema-tau', type=float, default=cf.EMA_TAU,
+                        help='''See `classify_faces.py`.''')
+    parser.add_argument('--segment-pool', type=int,
+                        default=cf.SEGMENT_POOL_SIZE,
+                        help='''See `classify_faces.py`.''')
+    args = parser.parse_args()
+    EXTRACT_OPTIONS = DEFAULT_OPTIONS._replace(
+        mode=args.faces, max_faces=args.max_faces, upsample=args.upsample,
+        model=args.detector, max_size=args.max_size)
+    USE_CACHE = not args.no_cache
+    cf.USE_ANN_INDEX = args.ann
+    cf.EMA_TAU = args.ema_tau
+    cf.SEGMENT_POOL_SIZE = args.segment_pool
+
+    main(global_mode=args.global_mode, processes=args.processes)
+    print('All done!')
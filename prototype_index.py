@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Approximate nearest-neighbour index over class prototypes.
+
+Even vectorized, matching a face against every prototype is O(classes), which
+hurts in global mode or in huge segments. `IVFIndex` is a pure-NumPy inverted
+file index: prototypes are bucketed by their nearest coarse centroid
+(k-means), and a face is only compared against prototypes in the `nprobe`
+buckets nearest to it. Candidates are then re-checked with exact distances
+against the tolerance by `PrototypeMatrix.match()`, so the index could only
+miss a match, never invent one.
+
+The index is trained lazily once enough prototypes exist, new prototypes are
+inserted into their nearest bucket as they are created, and it is retrained
+whenever the prototype count doubles. See `benchmarks/bench_prototype_index.py`
+for recall and speed against exhaustive search.
+'''
+
+import itertools
+
+import numpy as np
+
+
+''' Configurations '''
+
+# below this many prototypes, exhaustive search is used, as `NPROBE` of the
+# few buckets there would scan a large part of them anyway
+MIN_TRAIN_SIZE = 8192
+# number of buckets is `LISTS_FACTOR * sqrt(prototypes)`
+LISTS_FACTOR = 1.
+# buckets searched per query
+NPROBE = 16
+KMEANS_ITERATIONS = 10
+# max training samples per bucket
+KMEANS_SAMPLES_PER_LIST = 64
+
+
+''' Helper Functions '''
+
+def squared_distances(x, centroids):
+    '''
+    pairwise squared L2 distances, `x` of shape `[n, d]`, `centroids` of shape
+    `[k, d]`, returns shape `[n, k]`
+    '''
+    return (np.einsum('ij,ij->i', x, x)[:, None]
+            - 2 * x @ centroids.T
+            + np.einsum('ij,ij->i', centroids, centroids)[None, :])
+
+
+def kmeans(x, k, iterations=KMEANS_ITERATIONS, seed=0):
+    '''
+    plain Lloyd's k-means
+
+    Return:
+        centroids of shape `[k, d]`
+    '''
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmin(squared_distances(x, centroids), axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        # re-seed empty buckets with random points
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty))]
+    return centroids
+
+
+''' Index '''
+
+class IVFIndex(object):
+    '''
+    inverted file index over rows of a `PrototypeMatrix`
+
+    The owning `PrototypeMatrix` calls `add()` for every new row, `remap()`
+    after rows are compacted, and `candidates()` on every match.
+    '''
+
+    def __init__(self, nprobe=NPROBE, min_train_size=MIN_TRAIN_SIZE,
+                 lists_factor=LISTS_FACTOR, seed=0):
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.lists_factor = lists_factor
+        self.seed = seed
+        self.centroids = None
+        self.assign = []        # bucket of each row
+        self.lists = []         # rows in each bucket
+        self._trained_size = 0
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def _nearest(self, x, count=1):
+        dist = squared_distances(np.atleast_2d(x), self.centroids)[0]
+        if count == 1:
+            return [int(np.argmin(dist))]
+        count = min(count, len(dist))
+        return np.argpartition(dist, count - 1)[:count]
+
+    def _rebuild_lists(self):
+        self.lists = [[] for _ in range(len(self.centroids))]
+        for row, bucket in enumerate(self.assign):
+            self.lists[bucket].append(row)
+
+    def train(self, matrix):
+        '''
+        (re)train centroids on all current prototypes, and re-bucket them
+
+        Args:
+            `matrix`: valid rows of prototype matrix
+        '''
+        n = len(matrix)
+        k = max(int(self.lists_factor * np.sqrt(n)), 1)
+        samples = matrix
+        if n > k * KMEANS_SAMPLES_PER_LIST:
+            rng = np.random.RandomState(self.seed)
+            samples = matrix[rng.choice(n, k * KMEANS_SAMPLES_PER_LIST,
+                                        replace=False)]
+        self.centroids = kmeans(samples, k, seed=self.seed)
+        self.assign = np.argmin(squared_distances(matrix, self.centroids),
+                                axis=1).tolist()
+        self._rebuild_lists()
+        self._trained_size = n
+
+    def add(self, matrix, row):
+        '''
+        register new row `row` of the prototype matrix
+
+        Args:
+            `matrix`: valid rows of prototype matrix, including `row`
+            `row`: the new row
+        '''
+        n = len(matrix)
+        if not self.trained:
+            if n >= self.min_train_size:
+                self.train(matrix)
+            return
+        if n >= 2 * self._trained_size:
+            self.train(matrix)
+            return
+        bucket = self._nearest(matrix[row])[0]
+        self.assign.append(bucket)
+        self.lists[bucket].append(row)
+
+    def remap(self, keep):
+        '''
+        follow compaction of the prototype matrix, where new row `i` is old
+        row `keep[i]`
+        '''
+        if not self.trained:
+            return
+        self.assign = [self.assign[row] for row in keep]
+        self._rebuild_lists()
+
+    def candidates(self, encoding):
+        '''
+        rows worth an exact comparison with `encoding`
+
+        Return:
+            `np.ndarray` of rows, or `None` if not trained yet, meaning all
+            rows are candidates
+        '''
+        if not self.trained:
+            return None
+        buckets = self._nearest(encoding, self.nprobe)
+        return np.fromiter(
+            itertools.chain.from_iterable(self.lists[b] for b in buckets),
+            dtype=np.int64)
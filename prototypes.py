@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+In-memory class prototypes for the classifier.
+
+Instead of querying `seen_classes` and the typical encoding of each class one
+by one for every record, all prototypes of the active segment are kept as
+rows of a single `float32` matrix, and a face is matched against all of them
+with one vectorized distance computation.
+'''
+
+import numpy as np
+
+from encoding_store import ENCODING_DIM, ENCODING_DTYPE
+
+
+''' Configurations '''
+
+INITIAL_CAPACITY = 64
+
+
+''' Prototype Matrix '''
+
+class PrototypeMatrix(object):
+    '''
+    growable matrix of class prototypes, along with their class IDs, member
+    counts and typical record IDs
+
+    A prototype is the encoding of the first member of its class, or a
+    running average of its members if `hit()` is given a `tau`.
+
+    Row `i` describes class `klasses[i]`, only the first `len(self)` rows are
+    valid. Rows changed since the last `pop_dirty()` are flagged in `dirty`,
+    and class IDs pruned since the last `pop_removed()` are kept in
+    `removed`, so that they could be written back in one batch.
+
+    With an `index` (see `prototype_index.py`), `match()` only compares
+    against candidates suggested by the index.
+    '''
+
+    def __init__(self, capacity=INITIAL_CAPACITY, dim=ENCODING_DIM,
+                 index=None):
+        self.index = index
+        self.size = 0
+        self.matrix = np.empty((capacity, dim), dtype=ENCODING_DTYPE)
+        self.klasses = np.empty(capacity, dtype=np.int64)
+        self.first_ids = np.empty(capacity, dtype=np.int64)
+        self.counts = np.empty(capacity, dtype=np.int64)
+        self.dirty = np.zeros(capacity, dtype=bool)
+        self.removed = []
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self):
+        capacity = 2 * len(self.klasses)
+        for name in ('matrix', 'klasses', 'first_ids', 'counts', 'dirty'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, klass, encoding, first_id, count=1, dirty=True):
+        '''
+        register a new class
+
+        Args:
+            `klass`: class ID
+            `encoding`: typical encoding of the class
+            `first_id`: record ID of the typical encoding
+            `count`: member count
+            `dirty`: `False` if the class is loaded from database as is
+
+        Return:
+            row of the new class
+        '''
+        if self.size == len(self.klasses):
+            self._grow()
+        row = self.size
+        self.matrix[row] = encoding
+        self.klasses[row] = klass
+        self.first_ids[row] = first_id
+        self.counts[row] = count
+        self.dirty[row] = dirty
+        self.size += 1
+        if self.index is not None:
+            self.index.add(self.matrix[:self.size], row)
+        return row
+
+    def hit(self, row, encoding=None, tau=0.):
+        '''
+        count a new member of class at `row`, and if `tau` is non-zero, move
+        the prototype towards it as `(1 - tau) * old + tau * encoding`
+
+        NOTE: With an index, the prototype stays in its bucket even if it
+              drifts away, until the index is retrained.
+        '''
+        self.counts[row] += 1
+        self.dirty[row] = True
+        if tau:
+            self.matrix[row] *= 1 - tau
+            self.matrix[row] += tau * np.asarray(encoding,
+                                                 dtype=ENCODING_DTYPE)
+
+    @property
+    def changed(self):
+        '''
+        `True` if classes were changed or pruned since last `pop_dirty()` and
+        `pop_removed()`
+        '''
+        return bool(self.removed) or bool(self.dirty[:self.size].any())
+
+    def pop_dirty(self):
+        '''
+        get rows changed since last call, and clear their dirty flags
+
+        Return:
+            `np.ndarray` of row numbers
+        '''
+        rows = np.flatnonzero(self.dirty[:self.size])
+        self.dirty[rows] = False
+        return rows
+
+    def pop_removed(self):
+        '''
+        get class IDs pruned since last call
+
+        Return:
+            `[ int ]`
+        '''
+        removed, self.removed = self.removed, []
+        return removed
+
+    def prune(self, clock, min_rate, min_age):
+        '''
+        drop infrequent classes, so that noise does not pile up in the compare
+        set
+
+        A class is dropped if it has lived for at least `min_age` ticks and
+        its member count per tick since it was created is below `min_rate`.
+        The clock ticks once per record processed, and is in record IDs, so
+        the age of a class is `clock - first_id`.
+
+        Args:
+            `clock`: current clock
+            `min_rate`: minimum `count / age` for a class to be kept
+            `min_age`: minimum age before a class could be dropped
+
+        Return:
+            number of classes dropped
+        '''
+        ages = clock - self.first_ids[:self.size]
+        drop = (ages >= min_age) & (self.counts[:self.size] < min_rate * ages)
+        if not drop.any():
+            return 0
+        keep = np.flatnonzero(~drop)
+        self.removed.extend(int(k) for k in self.klasses[:self.size][drop])
+        for name in ('matrix', 'klasses', 'first_ids', 'counts', 'dirty'):
+            arr = getattr(self, name)
+            arr[:len(keep)] = arr[keep]
+        self.size = len(keep)
+        if self.index is not None:
+            self.index.remap(keep)
+        return int(drop.sum())
+
+    def distances(self, encoding, rows=None):
+        '''
+        L2 distances from `encoding` to all prototypes (or those at `rows`),
+        the same metric as `face_recognition.face_distance()`
+        '''
+        matrix = self.matrix[:self.size] if rows is None else self.matrix[rows]
+        diff = matrix - np.asarray(encoding, dtype=ENCODING_DTYPE)
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+    def match(self, encoding, tolerance):
+        '''
+        find the class `encoding` belongs to
+
+        Among all prototypes within `tolerance`, the one with the most members
+        wins, i.e. the first hit when comparing in descending order of member
+        counts.
+
+        Args:
+            `encoding`: a single face encoding
+            `tolerance`: maximum distance to be considered a match, see
+                `face_recognition.compare_faces()`
+
+        Return:
+            row of the matched class, or `None` if no class matches
+        '''
+        if self.size == 0:
+            return None
+        rows = None
+        if self.index is not None:
+            rows = self.index.candidates(encoding)
+        if rows is None:
+            hits = np.flatnonzero(self.distances(encoding) <= tolerance)
+        else:
+            hits = rows[self.distances(encoding, rows) <= tolerance]
+        if len(hits) == 0:
+            return None
+        return int(hits[np.argmax(self.counts[hits])])
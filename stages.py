@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Staged producer / consumer execution with backpressure.
+
+Run strictly in sequence, the disk idles while faces are encoded, and the CPU
+idles while `pandas` parses the next chunk or SQLite commits the last one.
+Here a script is split into stages, each running in its own thread and handed
+work through a `ByteQueue`, which blocks producers once the items queued add
+up to `max_bytes`. Stages overlap, and memory stays capped however slow the
+slowest stage is::
+
+    reader thread  --ByteQueue-->  calling thread  --ByteQueue-->  writer thread
+    (`source`)                     (`process`)                     (`sink`)
+
+`process` usually hands the heavy lifting to an `EncodingServer`, so it is
+the worker pool that runs in parallel. SQLite connections can't be shared
+across threads, so each stage opens its own, and only the writer thread
+writes.
+
+An exception in any stage aborts the others, and is re-raised in the calling
+thread.
+'''
+
+import threading
+
+from collections import deque
+
+
+''' Configurations '''
+
+# bytes queued between two stages
+QUEUE_BYTES = 256 * 2 ** 20
+
+
+''' Queue '''
+
+class StageAborted(Exception):
+    '''
+    raised in a stage when another one failed
+    '''
+
+
+class ByteQueue(object):
+    '''
+    FIFO queue bounded by total size of items in bytes
+
+    An item larger than `max_bytes` is still accepted when the queue is
+    empty, so nothing could block forever.
+    '''
+
+    _END = object()
+
+    def __init__(self, max_bytes=QUEUE_BYTES):
+        self.max_bytes = max_bytes
+        self._items = deque()
+        self._bytes = 0
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def put(self, item, size=0):
+        with self._cond:
+            while self._items and self._bytes + size > self.max_bytes \
+                    and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise StageAborted()
+            self._items.append((item, size))
+            self._bytes += size
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while not self._items and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise StageAborted()
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        '''
+        mark end of items, regardless of size limit
+        '''
+        with self._cond:
+            self._items.append((self._END, 0))
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is self._END:
+                return
+            yield item
+
+
+''' Stages '''
+
+class _Stage(threading.Thread):
+
+    def __init__(self, target, queues):
+        super(_Stage, self).__init__(daemon=True)
+        self._target = target
+        self._queues = queues
+        self.error = None
+
+    def run(self):
+        try:
+            self._target()
+        except StageAborted:
+            pass
+        except BaseException as e:
+            self.error = e
+            for queue in self._queues:
+                queue.abort()
+
+
+def _feed(items, queue, sizeof):
+    for item in items:
+        queue.put(item, sizeof(item))
+    queue.close()
+
+
+def _raise_errors(stages):
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+
+def prefetch(source, sizeof=len, max_bytes=QUEUE_BYTES):
+    '''
+    iterate over `source` in a background reader thread
+
+    Args:
+        `source`: iterable, e.g. `iter_chunks()`
+        `sizeof`: approximate size of an item in bytes
+        `max_bytes`: max bytes of items read ahead
+
+    Return:
+        iterator over items of `source`
+    '''
+    queue = ByteQueue(max_bytes)
+    reader = _Stage(lambda: _feed(source, queue, sizeof), [queue])
+    reader.start()
+    try:
+        for item in queue:
+            yield item
+    except StageAborted:
+        pass
+    finally:
+        # stop the reader if the consumer quits early
+        queue.abort()
+        reader.join()
+    _raise_errors([reader])
+
+
+def run_stages(source, process, sink, source_sizeof=len, result_sizeof=len,
+               max_bytes=QUEUE_BYTES):
+    '''
+    run `source`, `process` and `sink` as overlapping stages
+
+    Args:
+        `source`: iterable, iterated in a reader thread
+        `process`: `process(items)` -> iterator of results, run in the
+            calling thread
+        `sink`: `sink(results)`, run in a writer thread, typically opens its
+            own database connection, writes and commits
+        `source_sizeof`, `result_sizeof`: approximate sizes of items and
+            results in bytes
+        `max_bytes`: max bytes queued between two stages
+    '''
+    results = ByteQueue(max_bytes)
+    writer = _Stage(lambda: sink(iter(results)), [results])
+    writer.start()
+    try:
+        for result in process(prefetch(source, source_sizeof, max_bytes)):
+            results.put(result, result_sizeof(result))
+        results.close()
+    except StageAborted:
+        pass
+    except BaseException:
+        results.abort()
+        raise
+    finally:
+        writer.join()
+    _raise_errors([writer])
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Shared SQLite access layer.
+
+All scripts open their databases with `connect()`, which replaces the default
+rollback journal and `synchronous=FULL` (an `fsync()` per commit, twice) with
+WAL and `synchronous=NORMAL`, memory-maps the file and enlarges the page
+cache. With WAL, readers (e.g. `dump_folders.py`) no longer block the writer.
+
+Statements on `encodings` are kept here as module constants, so every script
+sends the very same SQL text and `sqlite3` reuses its prepared statement from
+the per-connection cache. `GroupCommit` commits once per `GROUP_COMMIT_ROWS`
+rows or `GROUP_COMMIT_SECONDS` seconds, whichever comes first, instead of
+once per chunk.
+
+NOTE: With `synchronous=NORMAL` a power loss (not a crash of the script) may
+      roll back the last commits. Progress saved in the same database (e.g.
+      `breakpoints` of `classify_faces.py`) is rolled back along with them,
+      breakpoint files are only written after a commit.
+'''
+
+import time
+import sqlite3
+
+
+''' Configurations '''
+
+JOURNAL_MODE = 'WAL'
+SYNCHRONOUS = 'NORMAL'
+# bytes of the database file memory-mapped
+MMAP_SIZE = 1 << 30
+# negative means KiB, i.e. 256 MiB of page cache
+CACHE_SIZE = -(1 << 18)
+# only takes effect on newly created databases
+PAGE_SIZE = 8192
+# prepared statements cached per connection
+CACHED_STATEMENTS = 256
+# milliseconds to wait for locks of other connections, as `sqlite3` does
+BUSY_TIMEOUT_MS = 5000
+# `connect()` overrides for databases shared by workers on several hosts, WAL
+# and `mmap` rely on shared memory, which doesn't work across hosts
+SHARED_PRAGMAS = dict(journal_mode='DELETE', mmap_size=0,
+                      busy_timeout=60000)
+# max number of SQL variables in a single query, old SQLite limits it to 999
+SQL_VARIABLES_LIMIT = 500
+
+# `GroupCommit` commits after this many rows, or this many seconds
+GROUP_COMMIT_ROWS = int(1e4)
+GROUP_COMMIT_SECONDS = 30.
+
+
+''' Statements '''
+
+SELECT_ENCODING = '''
+    SELECT encoding FROM encodings
+    WHERE
+        id = ?
+'''
+
+# `{}` is the column to fetch
+SELECT_RANGE = '''
+    SELECT id, {} FROM encodings
+    WHERE
+        id BETWEEN ? AND ?
+'''
+
+# `{}` are the column to fetch and the `?` of each id, at most
+# `SQL_VARIABLES_LIMIT` of them
+SELECT_IN = '''
+    SELECT id, {} FROM encodings
+    WHERE
+        id IN ({})
+'''
+
+SELECT_IDS_BETWEEN = '''
+    SELECT id FROM encodings WHERE id BETWEEN ? AND ?
+'''
+
+INSERT_ENCODING = '''
+    INSERT INTO encodings
+        (id, encoding, count, box_top, box_right, box_bottom, box_left)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+# keeps `count` written by `extract_to_db.py`, which may differ from the
+# number of encodings in the blob
+UPDATE_COUNT = '''
+    UPDATE encodings
+    SET
+        count = ?
+    WHERE
+        id = ? AND count IS NULL
+'''
+
+UPDATE_BELONG = '''
+    UPDATE encodings
+    SET
+        belong = ?
+    WHERE
+        id = ?
+'''
+
+UPDATE_ORIG_CLASS = '''
+    UPDATE encodings
+    SET
+        orig_class = ?
+    WHERE
+        id = ?
+'''
+
+
+''' Connections '''
+
+def configure(db_connection, journal_mode=JOURNAL_MODE,
+              synchronous=SYNCHRONOUS, mmap_size=MMAP_SIZE,
+              cache_size=CACHE_SIZE, page_size=PAGE_SIZE,
+              busy_timeout=BUSY_TIMEOUT_MS):
+    '''
+    apply performance `PRAGMA`s to an open connection
+    '''
+    # NOTE: `PRAGMA` does not take `?` parameters, and `page_size` must be
+    #       set before the first table is created and WAL is turned on
+    db_connection.execute('PRAGMA busy_timeout = {:d}'.format(busy_timeout))
+    db_connection.execute('PRAGMA page_size = {:d}'.format(page_size))
+    db_connection.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+    db_connection.execute('PRAGMA synchronous = {}'.format(synchronous))
+    db_connection.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
+    db_connection.execute('PRAGMA cache_size = {:d}'.format(cache_size))
+    return db_connection
+
+
+def connect(path, **pragmas):
+    '''
+    open a tuned database connection
+
+    Args:
+        `path`: database path
+        `pragmas`: overrides of `configure()` arguments
+
+    Return:
+        `sqlite3.Connection`, to be used just as `sqlite3.connect()`
+    '''
+    db_connection = sqlite3.connect(path,
+                                    cached_statements=CACHED_STATEMENTS)
+    return configure(db_connection, **pragmas)
+
+
+''' Group Commit '''
+
+class GroupCommit(object):
+    '''
+    commit once per `rows` rows or `seconds` seconds
+
+    Usage::
+
+        group_commit = GroupCommit(db_connection, on_commit=save_breakpoint)
+        for chunk in chunks:
+            ...                             # write, without committing
+            group_commit.add(len(chunk))    # commits when due
+        group_commit.commit()               # commit the rest
+
+    `on_commit` is called right after each commit, so progress saved outside
+    the database never runs ahead of committed data.
+    '''
+
+    def __init__(self, db_connection, rows=GROUP_COMMIT_ROWS,
+                 seconds=GROUP_COMMIT_SECONDS, on_commit=None):
+        self.db_connection = db_connection
+        self.rows = rows
+        self.seconds = seconds
+        self.on_commit = on_commit
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def add(self, rows=1):
+        '''
+        register `rows` written rows, committing if due
+
+        Return:
+            `True` if committed
+        '''
+        self._pending += rows
+        if self._pending >= self.rows \
+                or time.monotonic() - self._last_commit >= self.seconds:
+            self.commit()
+            return True
+        return False
+
+    def commit(self):
+        self.db_connection.commit()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        if self.on_commit is not None:
+            self.on_commit()
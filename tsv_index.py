@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Byte-offset index for the original `.tsv` data.
+
+Parsing the ~150GB source from byte 0 on every run is what makes resuming
+slow: even the "Skipping this chunk" branches pay the full `pandas` parse cost.
+This module scans the file **once** and writes a compact sidecar, so that
+readers could seek straight to any record.
+
+The sidecar is a `.npz` file next to the `.tsv`, holding
+
+    - `offsets`: `uint64[n + 1]`, byte offset of each record, the last entry
+      being the file size
+    - `segment_codes`: `uint32[n]`, code of column 0 (the segment id) of each
+      record
+    - `segments`: `str[m]`, segment id of each code
+
+Build it with::
+
+    python tsv_index.py [path/to/FaceImageCroppedWithoutAlignment.tsv]
+'''
+
+from array import array
+
+import numpy as np
+import pandas as pd
+
+import os
+import sys
+
+
+''' Configurations '''
+
+ORIGINAL_DATA_PATH = '../FaceImageCroppedWithoutAlignment.tsv'
+INDEX_SUFFIX = '.idx.npz'
+CHUNK_SIZE = int(1e3)
+
+READ_BUFFER_SIZE = 1 << 24
+
+
+''' Index Building '''
+
+def get_index_path(tsv_path):
+    return tsv_path + INDEX_SUFFIX
+
+
+def build_index(tsv_path=ORIGINAL_DATA_PATH, index_path=None):
+    '''
+    scan the `.tsv` file and write its offset index sidecar
+
+    Args:
+        `tsv_path`: path to original data
+        `index_path`: where to save the index, defaults to
+            `get_index_path(tsv_path)`
+
+    Return:
+        path to the written index
+    '''
+    if index_path is None:
+        index_path = get_index_path(tsv_path)
+    offsets = array('Q')
+    segment_codes = array('I')
+    segments = {}
+    offset = 0
+    with open(tsv_path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        for line in f:
+            # blank lines are skipped by `pandas` too
+            if not line.strip():
+                offset += len(line)
+                continue
+            seg = line.split(b'\t', 1)[0].decode('utf-8')
+            code = segments.get(seg)
+            if code is None:
+                code = segments[seg] = len(segments)
+            offsets.append(offset)
+            segment_codes.append(code)
+            offset += len(line)
+            if len(offsets) % int(1e5) == 0:
+                print('Indexed {} records, {:.1f} GB...'
+                      .format(len(offsets), offset / 2 ** 30))
+    offsets.append(offset)
+    # `np.savez` appends `.npz` unless it's already there
+    with open(index_path, 'wb') as f:
+        np.savez(f,
+                 offsets=np.frombuffer(offsets, dtype=np.uint64),
+                 segment_codes=np.frombuffer(segment_codes, dtype=np.uint32),
+                 segments=np.array(sorted(segments, key=segments.get)))
+    print('Indexed {} records in {} segments to \'{}\'.'
+          .format(len(segment_codes), len(segments), index_path))
+    return index_path
+
+
+''' Index Access '''
+
+class TsvIndex(object):
+    '''
+    random access to the original `.tsv` data via its offset index
+    '''
+
+    def __init__(self, tsv_path, offsets, segment_codes, segments):
+        self.tsv_path = tsv_path
+        self.offsets = offsets
+        self.segment_codes = segment_codes
+        self.segments = segments
+        self._file = None
+
+    @classmethod
+    def load(cls, tsv_path=ORIGINAL_DATA_PATH, index_path=None):
+        '''
+        load index sidecar of `tsv_path`
+
+        Return:
+            `TsvIndex`, or `None` if the index was never built
+        '''
+        if index_path is None:
+            index_path = get_index_path(tsv_path)
+        if not os.path.exists(index_path):
+            return None
+        with np.load(index_path) as data:
+            return cls(tsv_path, data['offsets'], data['segment_codes'],
+                       data['segments'])
+
+    def __len__(self):
+        return len(self.segment_codes)
+
+    def offset(self, idx):
+        return int(self.offsets[idx])
+
+    def segment(self, idx):
+        return str(self.segments[self.segment_codes[idx]])
+
+    def segment_records(self):
+        '''
+        group records by segment in a single pass
+
+        Return:
+            `{ segment: np.ndarray }` of record ids of each segment, in file
+            order
+        '''
+        order = np.argsort(self.segment_codes, kind='stable')
+        ends = np.cumsum(np.bincount(self.segment_codes,
+                                     minlength=len(self.segments)))
+        starts = np.append(0, ends[:-1])
+        return {str(seg): order[start:end]
+                for seg, start, end in zip(self.segments, starts, ends)}
+
+    def read_line(self, idx):
+        '''
+        read raw line of record `idx`, with trailing newline stripped
+        '''
+        if self._file is None:
+            self._file = open(self.tsv_path, 'rb')
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        self._file.seek(int(start))
+        return self._file.read(int(end - start)).rstrip(b'\r\n')
+
+    def read_record(self, idx):
+        '''
+        read record `idx` as list of `str` columns
+        '''
+        return self.read_line(idx).decode('utf-8').split('\t')
+
+    def read_chunks(self, start=0, stop=None, chunksize=CHUNK_SIZE,
+                    **kwargs):
+        '''
+        `pd.read_csv` iterator starting at record `start`
+
+        Chunk indexes are shifted so that `rec.name` is still the global
+        record index, just as if the file is read from byte 0.
+
+        Args:
+            `start`: first record to read
+            `stop`: record to stop at (exclusive), `None` for end of file
+            `chunksize`: chunk size
+            `kwargs`: passed to `pd.read_csv`, e.g. `usecols`
+        '''
+        start = min(max(start, 0), len(self))
+        if stop is None or stop > len(self):
+            stop = len(self)
+        if start >= stop:
+            return
+        with open(self.tsv_path, 'rb') as f:
+            f.seek(self.offset(start))
+            reader = pd.read_csv(f, sep='\t', header=None,
+                                 chunksize=chunksize, nrows=stop - start,
+                                 **kwargs)
+            for chunk in reader:
+                chunk.index += start
+                yield chunk
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+''' Main '''
+
+if __name__ == '__main__':
+    build_index(sys.argv[1] if len(sys.argv) > 1 else ORIGINAL_DATA_PATH)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Xiaoguang Zhu'
+
+'''
+Column-projected streaming reader of the original `.tsv` data, shared by all
+scripts.
+
+Chunks are yielded as lists of lightweight `namedtuple` records holding only
+the requested columns, e.g.::
+
+    for chunk in iter_chunks(columns=('segment', 'image')):
+        for rec in chunk:
+            rec.idx, rec.segment, rec.image
+
+instead of `DataFrame`s walked with `iterrows()`, which builds a `Series` per
+row. Only requested columns are converted by `pandas`, and when the base64
+image column is not requested and an index built by `tsv_index.py` is
+available, the file is not read at all.
+'''
+
+from collections import namedtuple
+
+import pandas as pd
+
+from tsv_index import ORIGINAL_DATA_PATH, CHUNK_SIZE, TsvIndex
+
+
+''' Configurations '''
+
+# column name -> column number in original data
+COLUMNS = {
+    'segment':  0,      # base classification (Freebase MID), see README
+    'url':      2,      # source image URL
+    'image':    6,      # base64-encoded JPEG
+}
+
+
+''' Records '''
+
+_record_types = {}
+
+
+def get_record_type(columns):
+    '''
+    `namedtuple` of fields `idx` and `columns`
+    '''
+    columns = tuple(columns)
+    if columns not in _record_types:
+        _record_types[columns] = namedtuple('Record', ('idx',) + columns)
+    return _record_types[columns]
+
+
+''' Readers '''
+
+def _iter_index_chunks(index, start, stop, chunksize):
+    '''
+    fast path for `columns=('segment',)`, served from index only
+    '''
+    Record = get_record_type(('segment',))
+    segments = [str(seg) for seg in index.segments]
+    for chunk_start in range(start, stop, chunksize):
+        chunk_stop = min(chunk_start + chunksize, stop)
+        codes = index.segment_codes[chunk_start:chunk_stop].tolist()
+        yield [Record(idx, segments[code])
+               for idx, code in zip(range(chunk_start, chunk_stop), codes)]
+
+
+def _iter_frame_chunks(frames, columns, start, stop):
+    Record = get_record_type(columns)
+    usecols = [COLUMNS[col] for col in columns]
+    for frame in frames:
+        if frame.index[-1] < start:
+            print('Skipping chunk {} - {}...'
+                  .format(frame.index[0], frame.index[-1]))
+            continue
+        if stop is not None:
+            if frame.index[0] >= stop:
+                return
+            frame = frame[frame.index < stop]
+        if start > frame.index[0]:
+            frame = frame[frame.index >= start]
+        # `usecols` does not keep the requested order
+        frame = frame[usecols]
+        yield list(map(Record._make,
+                       frame.itertuples(index=True, name=None)))
+
+
+def iter_chunks(tsv_path=ORIGINAL_DATA_PATH, columns=('segment', 'image'),
+                start=0, stop=None, chunksize=CHUNK_SIZE):
+    '''
+    stream original data in chunks of lightweight records
+
+    Args:
+        `tsv_path`: path to original data
+        `columns`: names of columns to read, see `COLUMNS`
+        `start`: first record to read
+        `stop`: record to stop at (exclusive), `None` for end of file
+        `chunksize`: records per chunk
+
+    Return:
+        iterator over `[ Record(idx, *columns) ]`
+    '''
+    columns = tuple(columns)
+    usecols = sorted(COLUMNS[col] for col in columns)
+    index = TsvIndex.load(tsv_path)
+    if index is None:
+        print('No index found for \'{}\', reading from the very beginning...'
+              .format(tsv_path))
+        frames = pd.read_csv(tsv_path, sep='\t', header=None,
+                             usecols=usecols, chunksize=chunksize)
+        return _iter_frame_chunks(frames, columns, start, stop)
+    if stop is None or stop > len(index):
+        stop = len(index)
+    if columns == ('segment',):
+        return _iter_index_chunks(index, start, stop, chunksize)
+    print('Seeking to record {} with index...'.format(start))
+    frames = index.read_chunks(start, stop, chunksize, usecols=usecols)
+    return _iter_frame_chunks(frames, columns, start, stop)